@@ -0,0 +1,131 @@
+#!/home/cmeder/miniconda3/bin/python
+
+"""
+Fills missing data in many gage records at once.
+
+- Takes either a directory of gage files (all one agency) or a manifest csv listing each file
+- Per-agency read settings (header lines, column names, delimiter) plus Timestep, MaxGap and the
+  TimeZone records are shifted to, any of which can be overridden per file in the manifest
+- Fills each file with the streaming gage fill (Gage_Fill_Stream.py) across a process pool,
+  writing the usual <file>_filled.csv and <file>_missing_interp_summary.csv next to each input
+- A file that fails is recorded and the batch carries on
+- Returns: per-file status/timing report (BatchReport)
+
+Manifest format (csv with a header row), only FileName and Agency are required:
+FileName,Agency,Timestep,MaxGap,Delimiter,HeaderLines,TimeZone
+gages/12167000.txt,USGS,15,180,tab,32,
+gages/09217000.txt,USGS,15,180,tab,32,MST
+gages/KC_31g.csv,KC,,,,,
+
+"""
+
+import os
+import glob
+import time
+import traceback
+from multiprocessing import Pool
+import pandas as pd
+import Gage_Fill_Stream
+
+#
+# USER INPUTS
+#
+InputDir = 'gages' # directory of gage files, used when Manifest is None
+FilePattern = '*.txt' # files in InputDir to fill
+DirAgency = "USGS" # agency of every file in InputDir
+Manifest = None # e.g. 'gage_manifest.csv', overrides InputDir
+BatchReport = 'gage_fill_batch_report.csv'
+Processes = None # number of worker processes, None uses every core
+DateFormat = '%Y-%m-%d %H:%M'
+ChunkSize = 500000 # rows read per chunk in each worker
+
+# Read and fill settings per agency, HeaderLines is 0-based (0 is 1 header line) and varies with gage
+AgencySettings = {
+	"KC": { # King County
+		'HeaderLines': 0,
+		'ColumnNames': ['Site_Code','Collect Date (UTC)','Collect Date (local)','Stage','Discharge'],
+		'Delimiter': ',',
+		'Timestep': 15, # in minutes
+		'MaxGap': 180, # in minutes
+		'TimeZone': None, # None for PST, or a tz code such as 'MST' (see Gage_Fill_Engine.TZ_OFFSETS)
+	},
+	"USGS": {
+		'HeaderLines': 32,
+		'ColumnNames': ['Agency','Gage_ID','Datetime','Timezone','Discharge','Notes'],
+		'Delimiter': '\t',
+		'Timestep': 15, # in minutes
+		'MaxGap': 180, # in minutes
+		'TimeZone': None, # None for the gage's own standard time, or a tz code such as 'MST' or 'UTC'
+	},
+}
+
+#
+# END USER INPUTS
+#
+
+# Delimiters as they may be written in the manifest
+DELIMITERS = {'tab': '\t', '\\t': '\t', 'comma': ',', 'space': ' '}
+
+
+# Build the list of jobs (one dict of fill settings per file) from the manifest or directory
+def build_jobs(Manifest, InputDir, FilePattern, DirAgency, AgencySettings):
+	if Manifest is not None:
+		rows = pd.read_csv(Manifest, dtype=str, keep_default_na=False).to_dict('records')
+	else:
+		rows = [{'FileName': fn, 'Agency': DirAgency} for fn in sorted(glob.glob(os.path.join(InputDir, FilePattern)))]
+
+	jobs = []
+	for row in rows:
+		job = {'FileName': row['FileName'], 'Agency': row['Agency']}
+		if row.get('Name', '') != '':
+			job['Name'] = row['Name']
+		job.update(AgencySettings.get(row['Agency'], {}))
+		# Per-file overrides from the manifest, blank cells keep the agency setting
+		for key, convert in [('Timestep', int), ('MaxGap', int), ('HeaderLines', int),
+				('Delimiter', lambda d: DELIMITERS.get(d, d)), ('TimeZone', str)]:
+			if row.get(key, '') != '':
+				job[key] = convert(row[key])
+		jobs.append(job)
+	return jobs
+
+
+# Fill one file, never raises so one bad file does not stop the batch
+def fill_one(job):
+	start = time.time()
+	result = {'FileName': job['FileName'], 'Agency': job['Agency'], 'Status': 'OK',
+		'Seconds': 0.0, 'Missing': '', 'Filled': '', 'Dropped': '', 'Error': ''}
+	try:
+		if 'ColumnNames' not in job:
+			raise ValueError("No settings for agency {}".format(job['Agency']))
+		filler = Gage_Fill_Stream.stream_fill_file(job['FileName'], job['Agency'], job['Timestep'], job['MaxGap'],
+			job['HeaderLines'], job['ColumnNames'], job['Delimiter'], DateFormat=DateFormat, ChunkSize=ChunkSize,
+			TimeZone=job.get('TimeZone'))
+		result.update({'Missing': filler.num_missing, 'Filled': filler.num_filled, 'Dropped': filler.dropped})
+	except Exception as e:
+		result['Status'] = 'FAILED'
+		result['Error'] = "{}: {}".format(type(e).__name__, e)
+		traceback.print_exc()
+	result['Seconds'] = round(time.time() - start, 2)
+	return result
+
+
+if __name__ == '__main__':
+	jobs = build_jobs(Manifest, InputDir, FilePattern, DirAgency, AgencySettings)
+	print("Filling {} gage files".format(len(jobs)))
+
+	batch_start = time.time()
+	results = []
+	with Pool(processes=Processes) as pool:
+		# imap_unordered reports each file as soon as it finishes
+		for result in pool.imap_unordered(fill_one, jobs):
+			print("{Status:6} {Seconds:8.2f}s  {FileName} {Error}".format(**result))
+			results.append(result)
+
+	# Write the report in the order of the input list
+	order = {job['FileName']: i for i, job in enumerate(jobs)}
+	results.sort(key=lambda r: order[r['FileName']])
+	pd.DataFrame(results).to_csv(BatchReport, index=False)
+
+	failed = sum(r['Status'] != 'OK' for r in results)
+	print("Finished {} files in {:.1f}s, {} failed".format(len(results), time.time() - batch_start, failed))
+	print("Batch report: {}".format(BatchReport))
@@ -0,0 +1,267 @@
+#!/home/cmeder/miniconda3/bin/python
+
+"""
+Benchmarks for the gage fill scripts.
+
+- Timestamp parsing: per-line datetime.strptime (v1 scripts), pd.to_datetime with format
+  inference + .dt.round (pandas scripts) and Gage_Fill_Engine.parse_timestamps, on the
+  USGS and King County layouts
+- Prints wall time for each and checks all methods give the same times
+- Script startup: time to start python and import the packages of a fill-only run versus a
+  run that also plots (matplotlib, seaborn), each in a fresh interpreter
+- Fill scripts: generates synthetic USGS and King County records (Gage_Fill_Synthetic.py) and
+  runs each of the four fill scripts on them, reporting wall time, peak memory and how each
+  filled output differs from the Gage_Fill_NoData.py output (the regression baseline)
+- Returns: tables printed for each benchmark, the fill script table also saved to BenchmarkReport
+
+"""
+
+import os
+import re
+import sys
+import time
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import Gage_Fill_Engine
+import Gage_Fill_Synthetic
+
+#
+# USER INPUTS
+#
+Benchmarks = ['startup', 'parse', 'scripts'] # which benchmarks to run
+NumRows = 1000000 # timestamps per layout
+Repeats = 3 # best of
+Layouts = {
+	'USGS RDB': '%Y-%m-%d %H:%M',
+	'USGS daily': '%Y-%m-%d',
+	'KC UTC': '%m/%d/%Y %H:%M:%S',
+}
+# Imports at the start of each kind of run
+Startup = {
+	'python only': 'pass',
+	'fill only': 'import numpy, pandas, Gage_Fill_Engine, Gage_Fill_Cache',
+	'fill + plot': 'import numpy, pandas, Gage_Fill_Engine, Gage_Fill_Cache, matplotlib.pyplot, seaborn; seaborn.set()',
+}
+# Synthetic records for the fill scripts, settings as in Gage_Fill_Synthetic.make_record
+Records = {
+	'usgs_100k': {'Agency': 'USGS', 'NumRows': 100000},
+	'usgs_gappy': {'Agency': 'USGS', 'NumRows': 100000, 'GapRate': 0.05, 'GapMean': 20, 'BlankFraction': 0.05,
+		'DuplicateFraction': 0.01},
+	'kc_100k': {'Agency': 'KC', 'NumRows': 100000},
+}
+Timestep = 15 # in minutes, for the fill scripts
+MaxGap = 180 # in minutes, for the fill scripts
+WorkDir = 'gage_benchmark' # synthetic records and script outputs are written here
+BenchmarkReport = 'gage_benchmark_report.csv'
+Python2 = None # python 2 interpreter for the python 2 scripts, None runs them with print statements ported to python 3
+
+#
+# END USER INPUTS
+#
+
+
+# Best wall time in seconds of Repeats calls, and the result of the last call
+def best_time(func):
+	best = None
+	for i in range(Repeats):
+		start = time.perf_counter()
+		result = func()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+
+# Timestamp parsing benchmark for one layout, returns rows of (layout, method, seconds, matches)
+def bench_parse(name, fmt, NumRows):
+	# 15-min readings with a few minutes of jitter and some seconds, as the loggers write them
+	rng = np.random.default_rng(0)
+	seconds = np.arange(NumRows, dtype=np.int64)*900 + 946684800 + rng.integers(-150, 150, NumRows)
+	text = pd.Series(pd.to_datetime(seconds, unit='s').strftime(fmt), dtype=object)
+	lines = text.tolist()
+
+	def strptime_loop():
+		dobj = []
+		for line in lines:
+			dobj.append(datetime.strptime(line, fmt))
+		return Gage_Fill_Engine.to_epoch_minutes(pd.Series(dobj).dt.round('15min').values)
+
+	def pandas_infer():
+		return Gage_Fill_Engine.to_epoch_minutes(pd.to_datetime(text).dt.round('15min').values)
+
+	def fixed_format():
+		return Gage_Fill_Engine.parse_timestamps(text, round_to=15)
+
+	rows = []
+	reference = None
+	for method, func in [('datetime.strptime per line', strptime_loop), ('pd.to_datetime (inferred)', pandas_infer),
+			('parse_timestamps', fixed_format)]:
+		seconds_taken, result = best_time(func)
+		if reference is None:
+			reference = result
+		rows.append((name, method, seconds_taken, bool((result == reference).all())))
+	return rows
+
+
+# Startup time of a fresh interpreter running each import line, returns rows of (run, seconds)
+def bench_startup(Startup):
+	rows = []
+	for name, code in Startup.items():
+		seconds_taken, result = best_time(lambda: subprocess.run([sys.executable, '-c', code], check=True))
+		rows.append((name, seconds_taken))
+	return rows
+
+
+# Each fill script: the python version it is written for and the agencies it reads
+SCRIPTS = [
+	('Gage_Fill_NoData.py', 2, ['USGS', 'KC']),
+	('Gage_Fill_NoData_python3.py', 3, ['USGS', 'KC']),
+	('USGS_Gage_Fill_NoData_v1.py', 2, ['USGS']),
+	('General_Gage_Fill_NoData_v1.py', 3, ['USGS']),
+]
+
+
+# User inputs of a fill script for one record
+def script_inputs(script, FileName, Agency, Timestep, MaxGap):
+	if script == 'Gage_Fill_NoData.py':
+		return {'FileName': FileName, 'Agency': Agency, 'Timestep': Timestep, 'MaxGap': MaxGap, 'CacheDir': None}
+	elif script == 'Gage_Fill_NoData_python3.py':
+		return {'FileName': FileName, 'Agency': Agency, 'Timestep': Timestep, 'MaxGap': MaxGap}
+	# v1 scripts, columns of the USGS RDB layout
+	inputs = {'filename': FileName, 'Qcol': 5, 'TScol': 3, 'timestep': Timestep, 'MaxGap': MaxGap}
+	if script == 'General_Gage_Fill_NoData_v1.py':
+		inputs.update({'FirstCharacter': 'U', 'DateFormat': '%Y-%m-%d %H:%M', 'delimiter': '\t', 'TZcol': 4})
+	return inputs
+
+
+# Source of a fill script with its user inputs replaced, and ported to python 3 if asked
+def script_source(script, inputs, port=False):
+	with open(script) as f:
+		source = f.read()
+	for name, value in inputs.items():
+		source, n = re.subn(r'^{}\s*=.*$'.format(name), lambda m: '{} = {!r}'.format(name, value), source, count=1,
+			flags=re.M)
+		if n == 0:
+			raise ValueError("No user input {} in {}".format(name, script))
+	source = re.sub(r'^os\.chdir\(.*$', '', source, flags=re.M)
+	if port:
+		# print statements and binary mode text writes are the only python 2 parts of the scripts
+		source = re.sub(r'^(\s*)print (.+)$', r'\1print(\2)', source, flags=re.M)
+		source = source.replace("'wb')", "'w')")
+	return source
+
+
+# Runs a script as __main__ then saves the peak memory of the process (VmHWM, Linux only) to peak_kb.txt
+# Measured in the child itself since the rusage of a forked child also counts the parent's memory
+LAUNCHER = (
+	"import sys, runpy\n"
+	"runpy.run_path(sys.argv[1], run_name='__main__')\n"
+	"try:\n"
+	"    peak = [l.split()[1] for l in open('/proc/self/status') if l.startswith('VmHWM')][0]\n"
+	"except (IOError, IndexError):\n"
+	"    peak = ''\n"
+	"open('peak_kb.txt', 'w').write(peak)\n")
+
+
+# Run a script in cwd, returns (wall seconds, peak memory in MB or None, exit code)
+def run_script(path, cwd, python):
+	here = os.path.dirname(os.path.abspath(__file__))
+	env = dict(os.environ, PYTHONPATH=os.pathsep.join([here, os.environ.get('PYTHONPATH', '')]), MPLBACKEND='Agg')
+	with open(os.path.join(cwd, 'run.log'), 'w') as log:
+		start = time.perf_counter()
+		code = subprocess.call([python, '-c', LAUNCHER, path], cwd=cwd, stdout=log, stderr=log, env=env)
+		seconds = time.perf_counter() - start
+	peak = None
+	if code == 0:
+		with open(os.path.join(cwd, 'peak_kb.txt')) as f:
+			text = f.read().strip()
+		peak = float(text)/1024.0 if text else None
+	return seconds, peak, code
+
+
+# Read a filled csv from any of the scripts (with or without a header row), returns (times, values)
+def read_filled(fout):
+	df = pd.read_csv(fout, header=None, names=['Datetime', 'Value'], dtype=str, keep_default_na=False)
+	df = df[df['Datetime'] != 'Datetime']
+	return (Gage_Fill_Engine.parse_timestamps(df['Datetime'].values),
+		pd.to_numeric(df['Value'], errors='coerce').values)
+
+
+# Differences of a filled output from the reference, returns (rows only in reference, rows only in output,
+# rows with a different value)
+def compare_filled(reference, output):
+	ref_times, ref_values = reference
+	times, values = output
+	common, i, j = np.intersect1d(ref_times, times, assume_unique=False, return_indices=True)
+	a, b = ref_values[i], values[j]
+	same = (a == b) | (np.isnan(a) & np.isnan(b)) | np.isclose(a, b, rtol=1e-9, atol=0)
+	return len(ref_times) - len(common), len(times) - len(common), int((~same).sum())
+
+
+# Run every fill script on every synthetic record, returns rows of the report
+def bench_scripts(Records, Timestep, MaxGap, WorkDir, Python2=None):
+	repo = os.path.dirname(os.path.abspath(__file__))
+	rows = []
+	for record, settings in Records.items():
+		settings = dict(settings)
+		Agency = settings.get('Agency', 'USGS')
+		FileName = record + '.txt'
+		Gage_Fill_Synthetic.make_record(os.path.join(WorkDir, FileName), Timestep=Timestep, **settings)
+
+		reference = None
+		for script, version, agencies in SCRIPTS:
+			if Agency not in agencies:
+				continue
+			# Each script runs in its own folder so the outputs do not overwrite each other
+			cwd = os.path.join(WorkDir, record, os.path.splitext(script)[0])
+			if not os.path.isdir(cwd):
+				os.makedirs(cwd)
+			with open(os.path.join(WorkDir, FileName)) as fin, open(os.path.join(cwd, FileName), 'w') as fcopy:
+				fcopy.write(fin.read())
+			port = version == 2 and Python2 is None
+			with open(os.path.join(cwd, script), 'w') as f:
+				f.write(script_source(os.path.join(repo, script), script_inputs(script, FileName, Agency, Timestep,
+					MaxGap), port))
+
+			python = Python2 if (version == 2 and Python2 is not None) else sys.executable
+			seconds, peak, code = run_script(script, cwd, python)
+			row = {'Record': record, 'Script': script, 'Seconds': seconds, 'Peak MB': peak, 'Status': 'OK',
+				'Output rows': '', 'Only in reference': '', 'Only in output': '', 'Different values': ''}
+			fout = os.path.join(cwd, FileName[:-4]+'_filled.csv')
+			if code != 0 or not os.path.exists(fout):
+				row['Status'] = 'FAILED (see {})'.format(os.path.join(cwd, 'run.log'))
+			else:
+				output = read_filled(fout)
+				reference = output if reference is None else reference
+				missing, extra, different = compare_filled(reference, output)
+				row.update({'Output rows': len(output[0]), 'Only in reference': missing, 'Only in output': extra,
+					'Different values': different})
+			rows.append(row)
+	return rows
+
+
+if __name__ == '__main__':
+	if 'startup' in Benchmarks:
+		print("Script startup, best of {}".format(Repeats))
+		df = pd.DataFrame(bench_startup(Startup), columns=['Run', 'Seconds'])
+		print(df.to_string(index=False, float_format='{:.3f}'.format))
+		print("")
+
+	if 'parse' in Benchmarks:
+		print("Timestamp parsing, {} rows, best of {}".format(NumRows, Repeats))
+		results = []
+		for name, fmt in Layouts.items():
+			results.extend(bench_parse(name, fmt, NumRows))
+		df = pd.DataFrame(results, columns=['Layout', 'Method', 'Seconds', 'Same times'])
+		print(df.to_string(index=False, float_format='{:.3f}'.format))
+		print("")
+
+	if 'scripts' in Benchmarks:
+		print("Fill scripts on synthetic records, outputs compared with the first script run on each record")
+		if not os.path.isdir(WorkDir):
+			os.makedirs(WorkDir)
+		df = pd.DataFrame(bench_scripts(Records, Timestep, MaxGap, WorkDir, Python2))
+		print(df.to_string(index=False, float_format='{:.2f}'.format))
+		df.to_csv(BenchmarkReport, index=False)
+		print("Benchmark report: {}".format(BenchmarkReport))
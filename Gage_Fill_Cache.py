@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Gage_Fill_Cache.py
+
+Binary cache of parsed gage records so reruns of the gage fill skip the text
+parse. A record is stored as two .npy columns (int64 epoch minutes after DST
+correction and rounding, float64 gage values) in a folder named by a hash of
+the input file contents plus the parse settings. Changing MaxGap or Timestep
+reuses the cache; editing the file or the read settings gives a new entry.
+
+- Cached columns are memory-mapped on load rather than read into memory
+- The cache folder is kept under a size limit by removing the least recently
+  used entries
+
+Kept Python 2/3 compatible like Gage_Fill_Engine.py.
+
+"""
+
+from __future__ import division, print_function
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# Bump when the layout of a cache entry changes so old entries are not read
+CACHE_VERSION = '1'
+
+COLUMNS = ['times', 'values']
+
+
+# Hash of the input file contents and the settings used to parse it
+def cache_key(filename, settings):
+    h = hashlib.sha1()
+    h.update(CACHE_VERSION.encode('utf-8'))
+    h.update(repr(sorted(settings.items())).encode('utf-8'))
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Memory-map a cached record, returns (times, values) or None if not cached
+def load_record(cache_dir, key):
+    entry = os.path.join(cache_dir, key)
+    paths = [os.path.join(entry, c + '.npy') for c in COLUMNS]
+    if not all(os.path.exists(p) for p in paths):
+        return None
+    # Touch the entry so eviction sees it as recently used
+    os.utime(entry, None)
+    return tuple(np.load(p, mmap_mode='r') for p in paths)
+
+
+# Save a parsed record to the cache, then evict old entries down to max_bytes
+def save_record(cache_dir, key, times, values, max_bytes=None):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return entry
+
+    # Write into a temporary folder and rename it into place, so a run that is
+    # interrupted (or a second run writing the same entry) never leaves half a record
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp_')
+    np.save(os.path.join(tmp, 'times.npy'), np.asarray(times, dtype=np.int64))
+    np.save(os.path.join(tmp, 'values.npy'), np.asarray(values, dtype=np.float64))
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if max_bytes is not None:
+        evict(cache_dir, max_bytes, keep=key)
+    return entry
+
+
+# Remove least recently used entries until the cache is no larger than max_bytes
+def evict(cache_dir, max_bytes, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path) or name.startswith('.tmp_'):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, name, path))
+
+    total = sum(e[1] for e in entries)
+    removed = []
+    for mtime, size, name, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed.append(name)
+    return removed
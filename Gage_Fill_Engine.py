@@ -0,0 +1,708 @@
+# -*- coding: utf-8 -*-
+"""
+Gage_Fill_Engine.py
+
+Array based routines shared by the gage fill scripts. Times are carried as
+int64 minutes since 1970-01-01 (naive, no timezone) so a whole record can be
+placed on its regular timestep grid with integer arithmetic instead of
+searching lists of datetime objects.
+
+- Parses whole columns of fixed-format timestamps straight to int64 epoch minutes
+- Converts lists of datetime objects to int64 epoch minutes
+- Shifts local times with any USGS tz_cd code (PDT, MST, EDT, ...) to one
+  fixed zone through a small table of offsets
+- Places observations onto the complete, regular timestep grid (searchsorted)
+- Finds gaps as (start, length) runs and fills them (linear, monotone cubic or
+  mean cycle) in one batched call
+- Summarises the gaps of a record, one row per gap and per water year
+- Formats grid times back to text in a single vectorized call and writes filled
+  records as csv in large blocks, or as a binary columnar file
+
+Kept Python 2/3 compatible so it can be imported from any of the gage fill
+scripts.
+
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+# Value written to time slots with no data
+NODATA = -901
+
+
+# Timestamp layouts recognised when no format is given, tried in this order.
+# Each is fixed width (zero padded) so it can be parsed by character position.
+# '%m/%d/%Y %H:%M:%S' covers King County 'Collect Date (UTC)' exports.
+KNOWN_DATE_FORMATS = ['%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                      '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M', '%m/%d/%Y']
+
+# Width of each supported strftime directive
+_FIELD_WIDTHS = {'Y': 4, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2}
+
+
+# Character positions of a fixed width date format, e.g. '%Y-%m-%d' gives
+# (10, {'Y': 0, 'm': 5, 'd': 8}, {4: '-', 7: '-'}). None if the format has
+# directives that are not fixed width (%b, %p, %I, ...).
+def _fixed_layout(date_format):
+    fields, literals, pos, i = {}, {}, 0, 0
+    while i < len(date_format):
+        if date_format[i] == '%':
+            key = date_format[i + 1:i + 2]
+            if key not in _FIELD_WIDTHS or key in fields:
+                return None
+            fields[key] = pos
+            pos += _FIELD_WIDTHS[key]
+            i += 2
+        else:
+            literals[pos] = date_format[i]
+            pos += 1
+            i += 1
+    return pos, fields, literals
+
+
+# Round int64 values to the nearest multiple of step, ties to even (as pandas .dt.round does)
+def _round_half_even(values, step):
+    q, r = np.divmod(values, step)
+    up = (2 * r > step) | ((2 * r == step) & (q % 2 == 1))
+    return (q + up) * step
+
+
+# Days since 1970-01-01 of a proleptic Gregorian (year, month, day), vectorized
+# integer form of the civil calendar so no datetime objects are created
+def _days_from_civil(year, month, day):
+    y = year - (month <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+
+
+# Days in each month of a non-leap year
+_MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+# Parse fixed width timestamp text by character position to int64 epoch
+# seconds, None if any value does not fit the layout. text is a bytes array
+# one character wider than the layout so longer values can be spotted.
+def _parse_fixed(text, layout):
+    width, fields, literals = layout
+    codes = text.view(np.uint8).reshape(-1, width + 1)
+    if codes[:, width].any():
+        return None
+    for pos, char in literals.items():
+        if (codes[:, pos] != ord(char)).any():
+            return None
+
+    # Digit values of every field character, anything that is not 0-9 wraps
+    # around to a large unsigned value
+    digit_cols = [c for key, start in fields.items() for c in range(start, start + _FIELD_WIDTHS[key])]
+    digits = codes[:, digit_cols] - np.uint8(ord('0'))
+    if (digits > 9).any():
+        return None
+    digits = digits.astype(np.int32)
+
+    def number(key, default=0):
+        if key not in fields:
+            return default
+        first = digit_cols.index(fields[key])
+        value = digits[:, first]
+        for col in range(first + 1, first + _FIELD_WIDTHS[key]):
+            value = value * 10 + digits[:, col]
+        return value
+
+    year, month, day = number('Y', 1970), number('m', 1), number('d', 1)
+    hour, minute, second = number('H'), number('M'), number('S')
+    if ((month < 1) | (month > 12) | (hour > 23) | (minute > 59) | (second > 59)).any():
+        return None
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    if ((day < 1) | (day > _MONTH_DAYS[month - 1] + (leap & (month == 2)))).any():
+        return None
+    days = _days_from_civil(year, month, day).astype(np.int64)
+    return days * 86400 + (hour * 3600 + minute * 60 + second)
+
+
+# Parse a column of timestamp text (list, array or Series) to int64 epoch minutes
+#
+# date_format - strftime layout of the text, or None to detect one of the
+#               KNOWN_DATE_FORMATS from the first value
+# round_to    - round each time to the nearest round_to minutes (ties to
+#               even, as .dt.round does), e.g. 15 to snap to 15 min readings
+#
+# Fixed width layouts are converted in a few vectorized integer operations on
+# the character codes. Anything else (unpadded values, other directives, bad
+# values) falls back to pd.to_datetime.
+def parse_timestamps(strings, date_format=None, round_to=1):
+    strings = np.asarray(strings)
+    if len(strings) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    if date_format is None:
+        candidates = KNOWN_DATE_FORMATS
+    else:
+        candidates = [date_format]
+    seconds = None
+    for fmt in candidates:
+        layout = _fixed_layout(fmt)
+        if layout is None or len(strings[0]) != layout[0]:
+            continue
+        try:
+            text = strings.astype('S{}'.format(layout[0] + 1))
+        except (UnicodeEncodeError, ValueError, TypeError):
+            break
+        seconds = _parse_fixed(text, layout)
+        if seconds is not None:
+            break
+
+    if seconds is None:
+        import pandas as pd
+        parsed = pd.to_datetime(pd.Series(strings), format=date_format)
+        seconds = parsed.values.astype('datetime64[s]').astype(np.int64)
+    return _round_half_even(seconds, 60 * int(round_to)) // 60
+
+
+# Convert a sequence of datetime objects (or datetime64 values) to int64 minutes
+def to_epoch_minutes(dates):
+    return np.asarray(dates, dtype='datetime64[m]').astype(np.int64)
+
+
+# UTC offset in minutes of each USGS tz_cd code
+TZ_OFFSETS = {
+    'UTC': 0, 'GMT': 0,
+    'AST': -240, 'ADT': -180, # Atlantic
+    'EST': -300, 'EDT': -240,
+    'CST': -360, 'CDT': -300,
+    'MST': -420, 'MDT': -360,
+    'PST': -480, 'PDT': -420,
+    'AKST': -540, 'AKDT': -480,
+    'HST': -600, # Hawaii has no daylight savings time
+}
+
+# Standard time zone of each daylight savings code
+STANDARD_ZONES = {'ADT': 'AST', 'EDT': 'EST', 'CDT': 'CST', 'MDT': 'MST', 'PDT': 'PST', 'AKDT': 'AKST'}
+
+
+# Minutes to add to a time in from_zone to give the same instant in to_zone,
+# e.g. zone_shift('UTC', 'PST') is -480
+def zone_shift(from_zone, to_zone):
+    for zone in (from_zone, to_zone):
+        if zone not in TZ_OFFSETS:
+            raise ValueError("Unknown time zone code: {}".format(zone))
+    return TZ_OFFSETS[to_zone] - TZ_OFFSETS[from_zone]
+
+
+# tz_cd text of a blank or missing code (NaN reads as 'nan')
+BLANK_CODES = ('', 'nan', 'None')
+
+
+# Minutes to add to each local time to put a whole column in one fixed zone
+#
+# codes   - tz_cd of each time (e.g. 'PST', 'PDT', 'MDT'), list, array or Series
+# to_zone - zone to convert to, or None for the standard time of the gage
+#           (the standard zone of the first non-blank code, e.g. PST for a PST/PDT record)
+#
+# Each distinct code is looked up once and the shift of every row is taken
+# from that small table by index, so the column is corrected with one integer
+# add of the result. Rows with a blank code are taken to be in the gage's
+# standard time, as the baseline passed them through unshifted.
+def standard_time_shift(codes, to_zone=None):
+    codes = np.char.strip(np.asarray(codes).astype('U'))
+    zones, index = np.unique(codes, return_inverse=True)
+    named = codes[~np.isin(codes, BLANK_CODES)]
+    standard = STANDARD_ZONES.get(named[0], named[0]) if len(named) else to_zone
+    if to_zone is None:
+        to_zone = standard
+    if standard is None:
+        # every code blank and no zone given, nothing to shift
+        return np.zeros(len(codes), dtype=np.int64)
+    table = np.array([zone_shift(standard if zone in BLANK_CODES else zone, to_zone) for zone in zones], dtype=np.int64)
+    return table[index.ravel()]
+
+
+# Convert int64 epoch minutes back to text, e.g. '2020-06-01 13:15'
+# '%Y-%m-%d %H:%M' and '%Y-%m-%d' (the layouts written by the gage fill
+# scripts) are formatted directly, any other format goes through pandas strftime
+def format_minutes(minutes, date_format='%Y-%m-%d %H:%M'):
+    stamps = np.asarray(minutes, dtype=np.int64).astype('datetime64[m]')
+    if date_format == '%Y-%m-%d %H:%M':
+        text = np.datetime_as_string(stamps, unit='m').astype('U16')
+        # swap the ISO 'T' separator for a space in place (character 11 of 16)
+        text.view('U1').reshape(-1, 16)[:, 10] = ' '
+        return text
+    elif date_format == '%Y-%m-%d':
+        return np.datetime_as_string(stamps, unit='D')
+    import pandas as pd
+    return np.asarray(pd.DatetimeIndex(stamps).strftime(date_format))
+
+
+# Write Datetime,Value csv rows for a whole timeseries, a block of rows at a time
+#
+# Gives the same text as DataFrame.to_csv(date_format=...) of a float column:
+# timestamps from format_minutes, values as repr(float) and NaN as na_rep
+# (repr keeps every digit on Python 2 as well, where str stops at 12).
+# Where nodata_rep is given, NODATA values are written as that text instead
+# (the v1 scripts write '-901'). f is an open file, header is the first line
+# (e.g. 'Datetime,Discharge') or None, lines end in '\n'.
+def write_csv_rows(f, times, values, date_format='%Y-%m-%d %H:%M', header=None, na_rep='',
+                   nodata_rep=None, block_rows=200000):
+    values = np.asarray(values, dtype=np.float64)
+    if header is not None:
+        f.write(header + '\n')
+    for start in range(0, len(values), block_rows):
+        block = values[start:start + block_rows]
+        text = list(map(repr, block.tolist()))
+        for i in np.flatnonzero(np.isnan(block)).tolist():
+            text[i] = na_rep
+        if nodata_rep is not None:
+            for i in np.flatnonzero(block == NODATA).tolist():
+                text[i] = nodata_rep
+        stamps = format_minutes(times[start:start + block_rows], date_format).tolist()
+        f.write('\n'.join(map(','.join, zip(stamps, text))) + '\n')
+
+
+# Save a filled timeseries as a binary columnar file (.npz of int64 epoch
+# minutes 'times' and float64 'values'), each column is read only when used
+def save_timeseries(filename, times, values):
+    np.savez(filename, times=np.asarray(times, dtype=np.int64), values=np.asarray(values, dtype=np.float64))
+
+
+# Load a timeseries written by save_timeseries, returns (times, values)
+def load_timeseries(filename):
+    data = np.load(filename)
+    return data['times'], data['values']
+
+
+# Read the last n_rows data rows of an existing filled csv (Datetime,Value
+# rows as written by the gage fill scripts) without reading the whole file.
+# Blank values are returned as NaN. Returns (times in epoch minutes, values,
+# byte offset of the start of each row).
+def read_filled_tail(filename, n_rows, date_format='%Y-%m-%d %H:%M'):
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        block = 64 * (n_rows + 2)
+        while True:
+            start = max(0, size - block)
+            f.seek(start)
+            data = f.read()
+            # Drop the (possibly partial) first line unless this is the top of the file
+            skip = 0 if start == 0 else data.find(b'\n') + 1
+            lines = data[skip:].splitlines(True)
+            if start == 0 or len(lines) > n_rows + 1:
+                break
+            block *= 4
+
+    offsets = start + skip + np.cumsum([0] + [len(l) for l in lines[:-1]])
+    rows = [(l.rstrip(b'\r\n'), o) for l, o in zip(lines, offsets) if l[:1].isdigit()][-n_rows:]
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64)
+    fields = [r[0].decode('ascii').split(',') for r in rows]
+    times = parse_timestamps([f[0] for f in fields], date_format)
+    values = np.array([float(f[1]) if f[1] else np.nan for f in fields])
+    return times, values, np.array([r[1] for r in rows], dtype=np.int64)
+
+
+# Ways readings that share a timestamp can be merged, see merge_duplicates
+DUPLICATE_METHODS = ['first', 'mean', 'max', 'last']
+
+
+# Merge readings that share a timestamp into one value, e.g. 5 min readings
+# rounded to 15 mins or the repeated hour at the autumn PDT -> PST changeover
+#
+# how - 'first' or 'last' reading in the file at each time (blank or not), or
+#       the 'mean' or 'max' of the readings with a value (NaN if none have one)
+#
+# One stable sort groups the readings of each time in file order and every
+# group is reduced at once (ufunc reduceat), no loop over times. Returns
+# (sorted unique times, merged values, number of readings at each time).
+def merge_duplicates(times, values, how='first'):
+    if how not in DUPLICATE_METHODS:
+        raise ValueError("Unknown duplicate method: {} (use one of {})".format(how, ', '.join(DUPLICATE_METHODS)))
+    times = np.asarray(times, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(times, kind='mergesort')
+    times, values = times[order], values[order]
+    if len(times) == 0:
+        return times, values, np.zeros(0, dtype=np.int64)
+
+    starts = np.flatnonzero(np.concatenate(([True], times[1:] != times[:-1])))
+    counts = np.diff(np.append(starts, len(times)))
+    if how == 'first':
+        merged = values[starts]
+    elif how == 'last':
+        merged = values[starts + counts - 1]
+    elif how == 'max':
+        # fmax skips NaN unless every reading at the time is NaN
+        merged = np.fmax.reduceat(values, starts)
+    else:
+        valid = ~np.isnan(values)
+        total = np.add.reduceat(np.where(valid, values, 0.0), starts)
+        n = np.add.reduceat(valid.astype(np.int64), starts)
+        with np.errstate(invalid='ignore'):
+            merged = total / n
+    return times[starts], merged, counts
+
+
+# Place observations onto an existing grid of times
+#
+# Where a timestamp is repeated the first reading in the file is kept, and
+# readings that fall between grid times are dropped. Grid slots with no
+# observation get the fill value. With return_hits=True the number of grid
+# slots that received a reading is also returned.
+def place_on_grid(grid, times, values, fill=NODATA, return_hits=False):
+    times = np.asarray(times, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    filled = np.full(len(grid), fill, dtype=np.float64)
+    if len(times) == 0 or len(grid) == 0:
+        return (filled, 0) if return_hits else filled
+
+    # stable sort keeps the first reading of a repeated timestamp first, so the
+    # left searchsorted match below is always the first occurrence in the file
+    order = np.argsort(times, kind='mergesort')
+    sorted_times = times[order]
+    idx = np.searchsorted(sorted_times, grid, side='left')
+    idx[idx == len(sorted_times)] = len(sorted_times) - 1
+    hit = sorted_times[idx] == grid
+    filled[hit] = values[order[idx[hit]]]
+    if return_hits:
+        return filled, int(hit.sum())
+    return filled
+
+
+# Place observations onto a complete timeseries with no gaps
+#
+# times    - int64 epoch minutes of the observations (need not be sorted)
+# values   - gage value for each observation
+# timestep - grid spacing in minutes
+#
+# The grid runs from the first observation up to (but not including) the last
+# observation, matching the original while-loop in the v1 scripts. Set
+# include_end=True to keep the last observation on the grid (as pd.date_range
+# does). Returns (grid times, filled values).
+def fill_regular_grid(times, values, timestep, nodata=NODATA, include_end=False):
+    times = np.asarray(times, dtype=np.int64)
+    start, end = times[0], times[-1]
+    if include_end:
+        end = end + 1
+    grid = np.arange(start, end, timestep, dtype=np.int64)
+    return grid, place_on_grid(grid, times, values, nodata)
+
+
+# Find runs of consecutive True values in a boolean mask (e.g. isnan(values))
+# Returns int64 arrays of run start positions and run lengths
+def gap_runs(mask):
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return starts.astype(np.int64), (ends - starts).astype(np.int64)
+
+
+# Expand (start, length) runs into the row positions they cover
+def run_positions(starts, lengths):
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = starts - (np.cumsum(lengths) - lengths)
+    return np.repeat(offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+
+
+# Slopes at the knots of a monotone piecewise cubic (Fritsch-Carlson, the
+# same end conditions as scipy's PchipInterpolator)
+def _pchip_slopes(x, y):
+    h = np.diff(x).astype(np.float64)
+    delta = np.diff(y) / h
+    if len(x) == 2:
+        return np.array([delta[0], delta[0]])
+
+    d = np.zeros(len(x))
+    # Interior knots: weighted harmonic mean of the secant slopes either side,
+    # zero where the data turns (keeps the fill within the values either side)
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same = (delta[:-1] * delta[1:]) > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:])
+    d[1:-1] = np.where(same, mean, 0.0)
+
+    # End knots: three point estimate, limited so the ends stay monotone
+    for end, h0, h1, m0, m1 in [(0, h[0], h[1], delta[0], delta[1]),
+                                (-1, h[-1], h[-2], delta[-1], delta[-2])]:
+        slope = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+        if np.sign(slope) != np.sign(m0):
+            slope = 0.0
+        elif np.sign(m0) != np.sign(m1) and abs(slope) > abs(3 * m0):
+            slope = 3 * m0
+        d[end] = slope
+    return d
+
+
+# Evaluate the monotone cubic through (x, y) at xi, xi within [x[0], x[-1]]
+def _pchip(xi, x, y):
+    d = _pchip_slopes(x, y)
+    k = np.clip(np.searchsorted(x, xi, side='right') - 1, 0, len(x) - 2)
+    h = (x[k + 1] - x[k]).astype(np.float64)
+    t = (xi - x[k]) / h
+    t2, t3 = t * t, t * t * t
+    return ((2 * t3 - 3 * t2 + 1) * y[k] + (t3 - 2 * t2 + t) * h * d[k] +
+            (-2 * t3 + 3 * t2) * y[k + 1] + (t3 - t2) * h * d[k + 1])
+
+
+# Interpolation methods for filling gaps, see interpolate_rows
+FILL_METHODS = ['linear', 'pchip', 'pattern']
+
+
+# Fill values at the given rows of a regular record in one batched call
+#
+# The knots are every valid value in the record (not NaN and not nodata), so
+# all gaps are filled together rather than one interpolation per gap.
+# - 'linear': straight line between the values either side of each gap
+# - 'pchip': monotone piecewise cubic, follows the curve of a rising or falling
+#   limb without overshooting the values either side of the gap
+# - 'pattern': the mean cycle of the record (e.g. the daily cycle, period =
+#   timesteps per day, or the seasonal cycle of daily data, period = 365) plus
+#   a straight line between the departures from it either side of each gap
+# Rows before the first valid value are NaN and rows after the last valid
+# value take the last value, as Series.interpolate() does.
+def interpolate_rows(values, rows, method='linear', period=None, nodata=NODATA):
+    values = np.asarray(values, dtype=np.float64)
+    rows = np.asarray(rows, dtype=np.int64)
+    valid = np.flatnonzero(~np.isnan(values) & (values != nodata))
+    if len(rows) == 0 or len(valid) == 0:
+        return np.full(len(rows), np.nan)
+
+    if method == 'linear' or len(valid) == 1:
+        filled = np.interp(rows, valid, values[valid])
+    elif method == 'pchip':
+        inside = np.clip(rows, valid[0], valid[-1])
+        filled = _pchip(inside, valid, values[valid])
+        filled[rows > valid[-1]] = values[valid[-1]]
+    elif method == 'pattern':
+        if not period or period < 2:
+            raise ValueError("The pattern fill needs a period of at least 2 timesteps")
+        period = int(period)
+        # Mean departure from the overall mean at each position in the cycle,
+        # positions never seen in the record get no adjustment
+        phase = valid % period
+        counts = np.bincount(phase, minlength=period)
+        sums = np.bincount(phase, weights=values[valid], minlength=period)
+        with np.errstate(invalid='ignore'):
+            cycle = sums / counts - values[valid].mean()
+        cycle[counts == 0] = 0.0
+        residual = values[valid] - cycle[phase]
+        filled = np.interp(rows, valid, residual) + cycle[rows % period]
+        filled[rows > valid[-1]] = values[valid[-1]]
+    else:
+        raise ValueError("Unknown fill method: {} (use one of {})".format(method, ', '.join(FILL_METHODS)))
+
+    filled[rows < valid[0]] = np.nan
+    return filled
+
+
+# Fill the gaps of a gage record from its gap index (see gap_runs)
+#
+# Gaps of max_gap timesteps or fewer are interpolated from the values either
+# side (see interpolate_rows for the methods), longer gaps are set to nodata.
+# As with Series.interpolate(), a short gap at the start of the record is left
+# as NaN and a short gap at the end takes the last value. Returns a new array.
+def fill_gaps(values, starts, lengths, max_gap, nodata=NODATA, method='linear', period=None):
+    values = np.asarray(values, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    out = values.copy()
+    short = lengths <= max_gap
+    out[run_positions(starts[~short], lengths[~short])] = nodata
+
+    rows = run_positions(starts[short], lengths[short])
+    if len(rows):
+        out[rows] = interpolate_rows(values, rows, method, period, nodata)
+    return out
+
+
+# Water year (1 October to 30 September, named for the year it ends in) of
+# each time in epoch minutes
+def water_year(minutes):
+    months = np.asarray(minutes, dtype=np.int64).astype('datetime64[m]').astype('datetime64[M]').astype(np.int64)
+    return months // 12 + 1970 + (months % 12 >= 9)
+
+
+# One row per gap of a filled record, from its gap index (see gap_runs)
+#
+# grid is the epoch minutes of each row and filled the values after
+# fill_gaps. A gap counts as filled when its rows were given values (not NaN
+# or nodata). The values either side are NaN at the start or end of the
+# record. Returns a list of (column name, array) pairs.
+def gap_table(grid, filled, starts, lengths, timestep, nodata=NODATA):
+    grid = np.asarray(grid, dtype=np.int64)
+    filled = np.asarray(filled, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = starts + lengths - 1
+    first = filled[starts] if len(starts) else np.empty(0)
+    was_filled = ~np.isnan(first) & (first != nodata)
+
+    # Padding with NaN either end gives the missing neighbour of a gap at the start or end of the record
+    padded = np.concatenate(([np.nan], filled, [np.nan]))
+    return [('Start', grid[starts]), ('End', grid[ends]), ('Duration (min)', lengths * timestep),
+            ('Timesteps', lengths), ('Filled', was_filled),
+            ('Value before', padded[starts]), ('Value after', padded[ends + 2])]
+
+
+# Missing and filled data per water year of a filled record
+#
+# Gaps are counted in the water year they start in, timesteps in the water
+# year they fall in. Returns a list of (column name, array) pairs.
+def water_year_stats(grid, filled, starts, lengths, timestep, nodata=NODATA):
+    grid = np.asarray(grid, dtype=np.int64)
+    filled = np.asarray(filled, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    wy = water_year(grid)
+    years = np.arange(wy[0], wy[-1] + 1)
+    row_year = wy - wy[0]
+    n = len(years)
+
+    missing = np.zeros(len(grid), dtype=bool)
+    missing[run_positions(starts, lengths)] = True
+    no_value = np.isnan(filled) | (filled == nodata)
+    total = np.bincount(row_year, minlength=n)
+    num_missing = np.bincount(row_year[missing], minlength=n)
+    num_filled = np.bincount(row_year[missing & ~no_value], minlength=n)
+
+    gap_year = row_year[starts]
+    gaps = np.bincount(gap_year, minlength=n)
+    gaps_filled = np.bincount(gap_year[~no_value[starts]], minlength=n)
+    longest = np.zeros(n, dtype=np.int64)
+    np.maximum.at(longest, gap_year, lengths * timestep)
+    complete = np.round(100.0 * (total - num_missing) / np.maximum(total, 1), 2)
+
+    return [('Water Year', years), ('Timesteps', total), ('Missing', num_missing), ('Interpolated', num_filled),
+            ('No data', num_missing - num_filled), ('Gaps', gaps), ('Gaps filled', gaps_filled),
+            ('Longest gap (min)', longest), ('Percent observed', complete)]
+
+
+# Fill a gage record that arrives in time ordered chunks with bounded memory
+#
+# Each call to push() takes the next block of observations (int64 epoch
+# minutes and values, NaN for no data) and returns the rows of the complete
+# timeseries that are now final as (times, values, missing flag, interp flag).
+# Gaps of max_gap timesteps or fewer are linearly interpolated, longer gaps
+# are set to NODATA, matching the pandas gage fill scripts:
+#
+# - A gap still open at the end of a chunk is carried to the next chunk. While
+#   it is short enough to be interpolated its slots are held back (at most
+#   max_gap of them); once it is longer it is written out as NODATA.
+# - A short gap at the start of the record is left as NaN (nothing to
+#   interpolate from) and a short gap at the end takes the last value.
+# - Readings at or before a time already written (duplicates after rounding,
+#   out of order rows) or between grid times are dropped and counted in
+#   self.dropped.
+#
+# Call finish() after the last chunk to get any rows still held back.
+class StreamingGapFiller(object):
+
+    def __init__(self, timestep, max_gap, nodata=NODATA):
+        self.timestep = int(timestep)
+        self.max_gap = int(max_gap)
+        self.nodata = nodata
+        self.next_time = None   # next grid time not yet seen
+        self.prev_value = np.nan   # last real value before any held gap
+        self.has_prev = False
+        self.gap_start = None   # first time of a held (short so far) gap
+        self.gap_len = 0   # length of the open gap, held or already written
+        self.gap_written = False
+        self.start_time = None
+        self.end_time = None
+        self.num_missing = 0
+        self.num_filled = 0
+        self.dropped = 0
+
+    def _empty(self):
+        return (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=bool),
+                np.empty(0, dtype=bool))
+
+    def push(self, times, values):
+        times = np.asarray(times, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if self.next_time is None and len(times):
+            self.next_time = times[0]
+            self.start_time = times[0]
+        keep = times >= self.next_time if len(times) else np.empty(0, dtype=bool)
+        self.dropped += int(len(times) - keep.sum())
+        times, values = times[keep], values[keep]
+        if len(times) == 0:
+            return self._empty()
+
+        # Rebuild any held gap in front of the new block so it is interpolated
+        # together with the value that closes it
+        held = self.gap_len if (self.gap_start is not None) else 0
+        start = self.gap_start if held else self.next_time
+        grid = np.arange(start, times.max() + 1, self.timestep, dtype=np.int64)
+        vals, hits = place_on_grid(grid, times, values, np.nan, return_hits=True)
+        self.dropped += len(times) - hits
+        missing = np.isnan(vals)
+        interp = np.zeros(len(grid), dtype=bool)
+        out = vals.copy()
+
+        starts, lengths = gap_runs(missing)
+        totals = lengths.copy()
+        if len(starts) and starts[0] == 0 and self.gap_written:
+            totals[0] += self.gap_len   # continuation of a gap already written out
+        is_open = (starts + lengths) == len(grid)
+        short = totals <= self.max_gap
+
+        # Classify every missing slot by the gap it belongs to
+        slots = np.flatnonzero(missing)
+        slot_short = np.repeat(short, lengths)
+        slot_fill = slot_short & ~np.repeat(is_open, lengths)
+
+        # Long gaps are no data, whether closed or still open
+        out[slots[~slot_short]] = self.nodata
+
+        # Short closed gaps are interpolated between the values either side, a
+        # short gap at the start of the record is flagged but left as NaN
+        interp[slots[slot_fill]] = True
+        if not self.has_prev and len(starts) and starts[0] == 0:
+            slot_fill[:lengths[0]] = False
+        if slot_fill.any():
+            pos = np.flatnonzero(~missing)
+            fp = vals[pos]
+            if self.has_prev:
+                pos = np.concatenate(([-1], pos))
+                fp = np.concatenate(([self.prev_value], fp))
+            out[slots[slot_fill]] = np.interp(slots[slot_fill], pos, fp)
+
+        # A short gap still open at the end of the block is held back
+        emit = len(grid)
+        self.gap_start, self.gap_written = None, False
+        if len(starts) and is_open[-1]:
+            self.gap_len = int(totals[-1])
+            if short[-1]:
+                emit = int(starts[-1])
+                self.gap_start = grid[emit]
+            else:
+                self.gap_written = True
+        else:
+            self.gap_len = 0
+
+        real = np.flatnonzero(~missing[:emit])
+        if len(real):
+            self.prev_value = vals[real[-1]]
+            self.has_prev = True
+        self.next_time = grid[-1] + self.timestep
+        self.end_time = grid[-1]
+        return self._emit(grid[:emit], out[:emit], missing[:emit], interp[:emit])
+
+    def finish(self):
+        if self.gap_start is None:
+            return self._empty()
+        # Short gap at the very end of the record takes the last value
+        grid = np.arange(self.gap_start, self.next_time, self.timestep, dtype=np.int64)
+        out = np.full(len(grid), self.prev_value if self.has_prev else np.nan)
+        self.gap_start, self.gap_len = None, 0
+        return self._emit(grid, out, np.ones(len(grid), dtype=bool),
+                          np.ones(len(grid), dtype=bool))
+
+    def _emit(self, grid, out, missing, interp):
+        self.num_missing += int(missing.sum())
+        self.num_filled += int(interp.sum())
+        return grid, out, missing, interp
@@ -18,16 +18,13 @@ June 2020
 """
 
 # Standard package imports
+import os
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-import pandas_bokeh
-import seaborn as sns
-# Seaborn settings
-sns.set(style="darkgrid")
-#sns.set_palette(sns.set_palette('colorblind'))
-sns.set_palette(sns.set_palette('pastel'))
+from datetime import timedelta
+import Gage_Fill_Engine
+import Gage_Fill_Cache
+# Plotting packages (matplotlib, seaborn, pandas_bokeh) are only imported when a plot is asked for below
 
 #
 # USER INPUTS
@@ -37,7 +34,18 @@ FileName = 'HamsFork_gageData.txt'
 Agency = "USGS" # KC (King County) or USGS 
 Timestep = 15 # in minutes
 MaxGap = 180 # in minutes
-DateFormat = '%Y-%m-%d %H:%M' # Format for export only, any datetime format is read in by Pandas, and converted once in memory
+FillMethod = 'linear' # gap fill: 'linear', 'pchip' (monotone cubic, follows rising/falling limbs) or 'pattern' (mean cycle plus a linear trend across the gap)
+FillPeriod = 1440 # length of the cycle used by the 'pattern' fill in minutes, e.g. 1440 for the daily cycle, 525600 for the seasonal cycle of daily data
+Duplicates = 'first' # readings that share a timestep after rounding: keep the 'first' or 'last', or take the 'mean' or 'max' of those with a value
+DateFormat = '%Y-%m-%d %H:%M' # Format for export only, known input layouts are parsed directly, any other datetime format is read in by Pandas
+TimeZone = None # zone the record is shifted to, None for the gage's standard time (PST for KC), or a tz code such as 'MST' or 'UTC' (see Gage_Fill_Engine.TZ_OFFSETS)
+Plot = False # True saves a quick check plot of the filled record (gage_data.png)
+PlotHtml = False # True also saves an interactive plot (gage_plot.html, needs pandas_bokeh)
+BinaryOutput = False # True also writes the filled record as a binary columnar file (*_filled.npz of epoch minutes and values)
+SummaryRows = False # True also lists every missing and interpolated timestep in the summary file, after the gap and water year tables
+CacheDir = 'gage_cache' # folder for the binary cache of parsed records (reruns skip the text parse), None to disable
+CacheMaxMB = 2000 # oldest cached records are removed to keep the cache folder under this size
+AppendTo = None # incremental mode: existing *_filled.csv to extend with the newer records in FileName, None fills the whole record
 
 # Set file read parameters
 if Agency == "KC": # King County
@@ -54,44 +62,80 @@ elif Agency == "USGS":
 # END USER INPUTS
 #
 
-# Load the gage data into a Pandas dataframe
-print("Reading input file: {}".format(FileName))
-df = pd.read_csv(FileName, delimiter=Delimiter, header=HeaderLines, names=ColumnNames, index_col=False)
-
-# Manage timestamps
-if Agency == "KC": # King County
-	# Convert to datetime64 format 
-	df['Collect Date (UTC)'] = pd.to_datetime(df['Collect Date (UTC)'])
-
-	# Round Datetime to the nearest 15 mins
-	df['Collect Date (UTC)'] = df['Collect Date (UTC)'].dt.round('15min') 
-
-	# Create new Datetime column for analysis equal to UTC shifted by 8 hrs to get PST (avoids dealing with daylight savings times)
-	df['Datetime'] = df['Collect Date (UTC)'] - timedelta(hours=8)
-
-elif Agency == "USGS":
-	# Convert to datetime64 format 
-	df['Datetime'] = pd.to_datetime(df['Datetime'])
-
-	# Round Datetime to the nearest 15 mins
-	df['Datetime'] = df['Datetime'].dt.round('15min') 
-
-	# Create new datetime64 column representing local time (including daylight savings effects) minus 1 hr
-	df['LocalDT_Minus_1hr'] = df['Datetime'] - pd.Timedelta(hours=1) 
-
-	# Update the Datetime column to shift daylight savings times (PDT) back to standard times
-	# When Timezone col is PDT (daylight savings time), set Datetime col to LocalDT_Minus_1hr, otherwise keep value in Datetime col (this is PST)
-	df['Datetime'] = np.where((df['Timezone'] == 'PDT'), df['LocalDT_Minus_1hr'], df['Datetime'])
-
-# Set the Datetime column as the index
-df.set_index('Datetime', inplace=True)
+# Look for this file in the cache of parsed records, keyed by the file contents and read settings
+# (changing Timestep or MaxGap still uses the cache)
+record = None
+if CacheDir is not None:
+	cache_key = Gage_Fill_Cache.cache_key(FileName, {'Agency': Agency, 'HeaderLines': HeaderLines,
+		'ColumnNames': ColumnNames, 'Delimiter': Delimiter, 'TimeZone': TimeZone})
+	record = Gage_Fill_Cache.load_record(CacheDir, cache_key)
+
+if record is not None:
+	# Build the dataframe from the memory-mapped, already DST corrected and rounded record
+	print("Reading cached record for input file: {}".format(FileName))
+	df = pd.DataFrame({'Discharge': record[1]}, index=pd.to_datetime(record[0], unit='m'))
+	df.index.name = 'Datetime'
+
+else:
+	# Load the gage data into a Pandas dataframe
+	print("Reading input file: {}".format(FileName))
+	df = pd.read_csv(FileName, delimiter=Delimiter, header=HeaderLines, names=ColumnNames, index_col=False)
+
+	# Manage timestamps
+	if Agency == "KC": # King County
+		# Convert to datetime64 format, rounded to the nearest 15 mins
+		# Timestamps in a known fixed layout are parsed straight to integer minutes (see Gage_Fill_Engine.parse_timestamps)
+		minutes = Gage_Fill_Engine.parse_timestamps(df['Collect Date (UTC)'], round_to=15)
+		df['Collect Date (UTC)'] = pd.to_datetime(minutes, unit='m')
+
+		# Create new Datetime column for analysis equal to UTC shifted to standard time, PST unless TimeZone is set (avoids dealing with daylight savings times)
+		df['Datetime'] = pd.to_datetime(minutes + Gage_Fill_Engine.zone_shift('UTC', TimeZone or 'PST'), unit='m')
+
+	elif Agency == "USGS":
+		# Convert to datetime64 format, rounded to the nearest 15 mins
+		# Timestamps in a known fixed layout are parsed straight to integer minutes (see Gage_Fill_Engine.parse_timestamps)
+		minutes = Gage_Fill_Engine.parse_timestamps(df['Datetime'], round_to=15)
+
+		# Shift every time to standard time in one integer add, the offset of each Timezone code (PDT, MDT, EST, ...)
+		# comes from a small lookup table (Gage_Fill_Engine.TZ_OFFSETS), e.g. PDT times go back 1 hr to PST
+		df['Datetime'] = pd.to_datetime(minutes + Gage_Fill_Engine.standard_time_shift(df['Timezone'], TimeZone), unit='m')
+
+	# Set the Datetime column as the index, keeping only the gage values
+	df.set_index('Datetime', inplace=True)
+	df = df[['Discharge']]
+
+	# Save the parsed record to the cache for the next run
+	if CacheDir is not None:
+		Gage_Fill_Cache.save_record(CacheDir, cache_key, Gage_Fill_Engine.to_epoch_minutes(df.index.values),
+			df['Discharge'].values, CacheMaxMB*1e6)
+
+# Incremental mode: keep the existing filled record and only fill from near its end
+# The last MaxGap worth of rows are re-evaluated together with the new records (a gap at the end of the old
+# record may now be closed), starting from the last real value in that window
+if AppendTo is not None:
+	tail_times, tail_values, tail_offsets = Gage_Fill_Engine.read_filled_tail(AppendTo, int(MaxGap/Timestep) + 1, DateFormat)
+	tail_values[tail_values == Gage_Fill_Engine.NODATA] = np.nan
+	real = np.flatnonzero(~np.isnan(tail_values))
+	first = real[0] if len(real) else 0
+	append_offset = tail_offsets[first]
+	df_tail = pd.DataFrame({'Discharge': tail_values[first:]}, index=pd.to_datetime(tail_times[first:], unit='m'))
+
+	# Records in the new file from the start of the window on, new readings replace old ones at the same time
+	# (old rows at a time the new file has are dropped, so they are never merged with the new readings below).
+	# A blank new reading at the start of the window would hide the value the window starts from, so it is dropped.
+	# A short gap at the very end of the old record was filled with its last value, those rows are only
+	# corrected if the new file repeats them, so download the new records from the old end date
+	df = df[(df.index > df_tail.index[0]) | ((df.index == df_tail.index[0]) & df['Discharge'].notnull())]
+	df = pd.concat([df, df_tail[~df_tail.index.isin(df.index)]]).sort_index(kind='mergesort')
+	df.index.name = 'Datetime'
+	print("Appending to {} from {}".format(AppendTo, df_tail.index[0].strftime('%Y-%m-%d %H:%M')))
 
 # Create complete timeseries at each timestep, get first and last time stamps
 start_time = df.index[0]
 end_time = df.index[-1]
 
 # Print read data for user verification
-print("Check correct columns were read \nNote that daylight savings timestamps are shifted back 1-hr from the input data")
+print("Check correct columns were read \nNote that daylight savings timestamps are shifted back to standard time from the input data")
 print("Timeseries start = {}".format(start_time.strftime('%Y-%m-%d %H:%M')))
 print("Timeseries end = {}".format(end_time.strftime('%Y-%m-%d %H:%M')))
 print("Gage value start = {:.1f}".format(df['Discharge'][0]))
@@ -101,93 +145,123 @@ print("Gage value start = {:.1f}".format(df['Discharge'][0]))
 delta = timedelta(minutes=Timestep)
 times = pd.date_range(start=start_time, end=end_time, freq=delta, tz=None)
 
-# Create a new df from the timeseries
-df_ts = pd.DataFrame(index=times)
-
-# Determine number of missing records in the original timeseries
-Num_missing = len(df_ts) - len(df)
-print "Missing records: {}".format(Num_missing)
-
-# Join the original gage data Dataframe (df) on index, leaves NaN where timestep is missing in original df
-df_full = df_ts.join(df)
-
-# Extract a new df of the original Datetime formatted Discharge rows with missing values
-df_missing = df_full[df_full['Discharge'].isnull()]
-
-# Remove duplicate timestamp values in the index
+# Merge readings that share a timestamp into one value (first, last, mean or max, see Duplicates above)
 # This occurs when the gage sometimes reads out data like, for example, 06:14 and then 06:15, since we rounded timestamps to the nearest 15 mins above.
 # Also occurs at the autumn changeover from PDT to PST, where there is a duplicate hour of records back to back.
-df_full = df_full[~df_full.index.duplicated()]
+obs_minutes, obs_values, obs_counts = Gage_Fill_Engine.merge_duplicates(Gage_Fill_Engine.to_epoch_minutes(df.index.values),
+	df['Discharge'].values, Duplicates)
+print("Duplicate readings merged ({}): {} into {} timesteps".format(Duplicates, len(df) - len(obs_minutes), (obs_counts > 1).sum()))
 
-# Drop unnecessary columns from the join
-if Agency == "KC":
-	df_full.drop(columns=['Site_Code','Collect Date (local)'], inplace=True)
-elif Agency == "USGS":
-	df_full.drop(columns=['Agency','Gage_ID','Notes'], inplace=True)
+# Place the merged readings on the complete timeseries in one pass, leaves NaN where timestep is missing in original df
+placed, hits = Gage_Fill_Engine.place_on_grid(Gage_Fill_Engine.to_epoch_minutes(times.values), obs_minutes, obs_values, np.nan,
+	return_hits=True)
+df_full = pd.DataFrame({'Discharge': placed}, index=times)
 
-# Fill missing timesteps (currently saved as NaN) with '-901' 
-df_full['Discharge'] = df_full['Discharge'].where(df_full['Discharge'].notnull(), -901)
+# Determine number of missing records in the original timeseries
+Num_missing = len(times) - hits
+print "Missing records: {}".format(Num_missing)
 
-# Create column which tracks sequential missing values of Discharge = -901 group size (how many -901's in a row)
-df_full['Consec_Length'] = df_full['Discharge'].groupby(df_full['Discharge'].diff().ne(0).cumsum()).transform('size')
+# Build the gap index: start row and length of every run of missing timesteps (NaN), in one pass over the NaN mask
+Discharge = df_full['Discharge'].values.astype(float)
+gap_starts, gap_lengths = Gage_Fill_Engine.gap_runs(np.isnan(Discharge))
 
 # Compute max allowable gap in missing timesteps for interpolation 
 TS_gap = int(MaxGap/Timestep)
 
-# Create flag to identify sections of missing data (-901) less than the max allowable gap 
-df_full['Interp_Flag'] = np.where(((df_full['Discharge'] == -901) & (df_full['Consec_Length'] <= TS_gap)), 1, 0)
+# Rows of every missing timestep, and of the gaps short enough to interpolate
+missing_rows = Gage_Fill_Engine.run_positions(gap_starts, gap_lengths)
+interp_gaps = gap_lengths <= TS_gap
+interp_rows = Gage_Fill_Engine.run_positions(gap_starts[interp_gaps], gap_lengths[interp_gaps])
 
-# Set Discharge = NaN for rows with Interp_Flag == 1 and Discharge == -901 
-# Need to do this to enable interpolation in these rows (ie. can't interpolate on -901 because its treated as actual data)
-df_full['Discharge'] = np.where(((df_full['Interp_Flag'] == 1) & (df_full['Discharge'] == -901)), np.nan, df_full['Discharge'])
-
-# Interpolate on rows where Interp_Flag = 1 
-print "Interpolating missing data in gaps less than {} timesteps".format(TS_gap)
-df_full['Discharge'] = np.where((df_full['Interp_Flag'] == 1), df_full['Discharge'].interpolate(), df_full['Discharge'])
-print "Filled records: {}".format(len(df_full[df_full['Interp_Flag'] == 1]))
+# Interpolate gaps less than or equal to the max allowable gap, fill longer gaps with '-901'
+print("Interpolating ({}) missing data in gaps less than {} timesteps".format(FillMethod, TS_gap))
+df_full['Discharge'] = Gage_Fill_Engine.fill_gaps(Discharge, gap_starts, gap_lengths, TS_gap, method=FillMethod,
+	period=int(FillPeriod/Timestep))
+print("Filled records: {}".format(len(interp_rows)))
 
 # Quick check plot to verify interpolation looks good
-f, ax = plt.subplots(figsize=(20,12))
-ax.plot(df_full['Discharge'], label='Discharge')
-ax.plot()
-ax.legend()
-#ax.grid()
-ax.set_xlabel('Datetime')
-ax.set_ylabel('Gage Value')
-plt.savefig('gage_data.png', bbox_inches='tight')
+if Plot:
+	# Agg draws straight to file, so this also works on machines with no display
+	import matplotlib
+	matplotlib.use('Agg')
+	import matplotlib.pyplot as plt
+	import seaborn as sns
+	# Seaborn settings
+	sns.set(style="darkgrid")
+	#sns.set_palette(sns.set_palette('colorblind'))
+	sns.set_palette(sns.set_palette('pastel'))
+
+	f, ax = plt.subplots(figsize=(20,12))
+	ax.plot(df_full['Discharge'], label='Discharge')
+	ax.plot()
+	ax.legend()
+	#ax.grid()
+	ax.set_xlabel('Datetime')
+	ax.set_ylabel('Gage Value')
+	plt.savefig('gage_data.png', bbox_inches='tight')
+	plt.close(f)
 
 # Make an interactive plot from a trimmed df with Pandas-Bokeh, save it out to html 
-#pandas_bokeh.output_file("gage_plot.html")
-#df_trim = df_full.drop(columns=['Consec_Length','Interp_Flag'])
-#df_trim.plot_bokeh()
+if PlotHtml:
+	import pandas_bokeh
+	pandas_bokeh.output_file("gage_plot.html")
+	df_trim = df_full[['Discharge']]
+	df_trim.plot_bokeh()
 
-# Write final, filled data to file
+# Write final, filled data to file, timestamps are formatted for the whole grid at once and rows written in large blocks
 print "Writing output file"
-ColNames = ['Discharge']
-fout = FileName[:-4]+'_filled.csv'
-df_full.to_csv(fout, columns=ColNames, index_label='Datetime', date_format=DateFormat)
-
-# Extract a new df of the rows where interpolation occurred (0 < Consec_Length < TS_gap)
-df_interp = df_full[df_full['Interp_Flag'] == 1]
-
-# Write summary of missing data & filled data
+grid_minutes = Gage_Fill_Engine.to_epoch_minutes(df_full.index.values)
+Discharge = df_full['Discharge'].values
+if AppendTo is not None:
+	# Cut the existing file back to the start of the re-evaluated window and append from there
+	fout = AppendTo
+	with open(fout, 'rb+') as f:
+		f.truncate(append_offset)
+	with open(fout, 'a') as f:
+		Gage_Fill_Engine.write_csv_rows(f, grid_minutes, Discharge, DateFormat)
+else:
+	fout = FileName[:-4]+'_filled.csv'
+	with open(fout, 'w') as f:
+		Gage_Fill_Engine.write_csv_rows(f, grid_minutes, Discharge, DateFormat, header='Datetime,Discharge')
+
+# Binary copy of the filled record next to the csv (in incremental mode the earlier part is kept from the existing copy)
+if BinaryOutput:
+	fbin = fout[:-4]+'.npz'
+	bin_minutes, bin_values = grid_minutes, Discharge
+	if AppendTo is not None and os.path.exists(fbin):
+		old_minutes, old_values = Gage_Fill_Engine.load_timeseries(fbin)
+		keep = old_minutes < grid_minutes[0]
+		bin_minutes = np.concatenate((old_minutes[keep], grid_minutes))
+		bin_values = np.concatenate((old_values[keep], Discharge))
+	Gage_Fill_Engine.save_timeseries(fbin, bin_minutes, bin_values)
+	print("Filled gage data binary file: {}".format(fbin))
+
+# Write summary of missing data & filled data: one row per gap (start, end, duration, whether it was filled and the values
+# either side) and per water year, then optionally every missing and interpolated timestep from the gap index
 fn = FileName[:-4]+'_missing_interp_summary.csv'
-
-# Setup the template for header above dataframe in csv, followed by 3 blank rows and then the dataframe
-template1 = """\
-Timesteps missing data:\n
-{}"""
+gap_columns = Gage_Fill_Engine.gap_table(grid_minutes, Discharge, gap_starts, gap_lengths, Timestep)
+df_gaps = pd.DataFrame(dict(gap_columns), columns=[name for name, values in gap_columns])
+df_gaps['Start'] = Gage_Fill_Engine.format_minutes(df_gaps['Start'].values, DateFormat)
+df_gaps['End'] = Gage_Fill_Engine.format_minutes(df_gaps['End'].values, DateFormat)
+df_gaps['Filled'] = np.where(df_gaps['Filled'], 'Yes', 'No')
+wy_columns = Gage_Fill_Engine.water_year_stats(grid_minutes, Discharge, gap_starts, gap_lengths, Timestep)
+df_wy = pd.DataFrame(dict(wy_columns), columns=[name for name, values in wy_columns])
+print("Gaps: {} ({} filled)".format(len(df_gaps), (df_gaps['Filled'] == 'Yes').sum()))
 
 with open(fn, 'w') as f:
-    f.write(template1.format(df_missing.to_csv(columns=ColNames, index_label='Datetime', date_format=DateFormat)))
-
-template2 = """\
-\nTimesteps interpolated:\n
-{}"""    
-
-with open(fn, 'a') as f:
-    f.write(template2.format(df_interp.to_csv(columns=ColNames, index_label='Datetime', date_format=DateFormat)))
+	f.write("Gaps in record:\n\n")
+	f.write(df_gaps.to_csv(index=False))
+	f.write("\nWater year summary:\n\n")
+	f.write(df_wy.to_csv(index=False))
+	if SummaryRows:
+		f.write("\nTimesteps missing data:\n\n")
+		Gage_Fill_Engine.write_csv_rows(f, grid_minutes[missing_rows], np.full(len(missing_rows), np.nan), DateFormat,
+			header='Datetime,Discharge')
+		f.write("\nTimesteps interpolated:\n\n")
+		Gage_Fill_Engine.write_csv_rows(f, grid_minutes[interp_rows], Discharge[interp_rows], DateFormat,
+			header='Datetime,Discharge')
 
 print "Filled gage data file: {}".format(fout)
 print "Summary of missing and filled date/times: {}".format(fn)
-print "Gage data plot: {}".format('gage_data.png')
\ No newline at end of file
+if Plot:
+	print("Gage data plot: {}".format('gage_data.png'))
\ No newline at end of file
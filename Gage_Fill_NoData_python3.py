@@ -20,14 +20,10 @@ June 2020
 # Standard package imports
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-#import pandas_bokeh
-import seaborn as sns
-# Seaborn settings
-sns.set(style="darkgrid")
-#sns.set_palette(sns.set_palette('colorblind'))
-sns.set_palette(sns.set_palette('pastel'))
+from datetime import timedelta
+import Gage_Fill_Engine
+import Gage_Fill_Stream
+# Plotting packages (matplotlib, seaborn, pandas_bokeh) are only imported when a plot is asked for below
 
 #
 # USER INPUTS
@@ -37,7 +33,16 @@ FileName = 'HamsFork_gageData.txt'
 Agency = "USGS" # KC (King County) or USGS 
 Timestep = 15 # in minutes
 MaxGap = 180 # in minutes
-DateFormat = '%Y-%m-%d %H:%M' # Format for export only, any datetime format is read in by Pandas, and converted once in memory
+FillMethod = 'linear' # gap fill: 'linear', 'pchip' (monotone cubic, follows rising/falling limbs) or 'pattern' (mean cycle plus a linear trend across the gap)
+FillPeriod = 1440 # length of the cycle used by the 'pattern' fill in minutes, e.g. 1440 for the daily cycle, 525600 for the seasonal cycle of daily data
+Duplicates = 'first' # readings that share a timestep after rounding: keep the 'first' or 'last', or take the 'mean' or 'max' of those with a value
+DateFormat = '%Y-%m-%d %H:%M' # Format for export only, known input layouts are parsed directly, any other datetime format is read in by Pandas
+TimeZone = None # zone the record is shifted to, None for the gage's standard time (PST for KC), or a tz code such as 'MST' or 'UTC' (see Gage_Fill_Engine.TZ_OFFSETS)
+Plot = False # True saves a quick check plot of the filled record (gage_data.png)
+PlotHtml = False # True also saves an interactive plot (gage_plot.html, needs pandas_bokeh)
+BinaryOutput = False # True also writes the filled record as a binary columnar file (*_filled.npz of epoch minutes and values)
+Streaming = False # True reads, fills and writes the file in chunks so memory stays flat for long records (no plot, linear fill and first duplicate only)
+ChunkSize = 500000 # rows read per chunk in streaming mode
 
 # Set file read parameters
 if Agency == "KC": # King County
@@ -54,140 +59,164 @@ elif Agency == "USGS":
 # END USER INPUTS
 #
 
-# Load the gage data into a Pandas dataframe
-print("Reading input file: {}".format(FileName))
-df = pd.read_csv(FileName, delimiter=Delimiter, header=HeaderLines, names=ColumnNames, index_col=False)
-
-# Manage timestamps
-if Agency == "KC": # King County
-	# Convert to datetime64 format 
-	df['Collect Date (UTC)'] = pd.to_datetime(df['Collect Date (UTC)'])
-
-	# Round Datetime to the nearest 15 mins
-	df['Collect Date (UTC)'] = df['Collect Date (UTC)'].dt.round('15min') 
-
-	# Create new Datetime column for analysis equal to UTC shifted by 8 hrs to get PST (avoids dealing with daylight savings times)
-	df['Datetime'] = df['Collect Date (UTC)'] - timedelta(hours=8)
-
-elif Agency == "USGS":
-	# Convert to datetime64 format 
-	df['Datetime'] = pd.to_datetime(df['Datetime'])
-
-	# Round Datetime to the nearest 15 mins
-	df['Datetime'] = df['Datetime'].dt.round('15min') 
-
-	# Create new datetime64 column representing local time (including daylight savings effects) minus 1 hr
-	df['LocalDT_Minus_1hr'] = df['Datetime'] - pd.Timedelta(hours=1) 
-
-	# Update the Datetime column to shift daylight savings times (PDT) back to standard times
-	# When Timezone col is PDT (daylight savings time), set Datetime col to LocalDT_Minus_1hr, otherwise keep value in Datetime col (this is PST)
-	df['Datetime'] = np.where((df['Timezone'] == 'PDT'), df['LocalDT_Minus_1hr'], df['Datetime'])
-
-# Set the Datetime column as the index
-df.set_index('Datetime', inplace=True)
-
-# Create complete timeseries at each timestep, get first and last time stamps
-start_time = df.index[0]
-end_time = df.index[-1]
-
-# Print read data for user verification
-print("Check correct columns were read \nNote that daylight savings timestamps are shifted back 1-hr from the input data")
-print("Timeseries start = {}".format(start_time.strftime('%Y-%m-%d %H:%M')))
-print("Timeseries end = {}".format(end_time.strftime('%Y-%m-%d %H:%M')))
-print("Gage value start = {:.1f}".format(df['Discharge'][0]))
-
-# Create a complete timeseries with 15-min timestep and a new dataframe to store the complete, filled timeseries
-# tz=None ensures this is timezone-naive
-delta = timedelta(minutes=Timestep)
-times = pd.date_range(start=start_time, end=end_time, freq=delta, tz=None)
-
-# Create a new df from the timeseries
-df_ts = pd.DataFrame(index=times)
-
-# Determine number of missing records in the original timeseries
-Num_missing = len(df_ts) - len(df)
-print("Missing records: {}".format(Num_missing))
-
-# Join the original gage data Dataframe (df) on index, leaves NaN where timestep is missing in original df
-df_full = df_ts.join(df)
-
-# Extract a new df of the original Datetime formatted Discharge rows with missing values
-df_missing = df_full[df_full['Discharge'].isnull()]
-
-# Remove duplicate timestamp values in the index
-# This occurs when the gage sometimes reads out data like, for example, 06:14 and then 06:15, since we rounded timestamps to the nearest 15 mins above.
-# Also occurs at the autumn changeover from PDT to PST, where there is a duplicate hour of records back to back.
-df_full = df_full[~df_full.index.duplicated()]
-
-# Drop unnecessary columns from the join
-if Agency == "KC":
-	df_full.drop(columns=['Site_Code','Collect Date (local)'], inplace=True)
-elif Agency == "USGS":
-	df_full.drop(columns=['Agency','Gage_ID','Notes'], inplace=True)
-
-# Fill missing timesteps (currently saved as NaN) with '-901' 
-df_full['Discharge'] = df_full['Discharge'].where(df_full['Discharge'].notnull(), -901)
-
-# Create column which tracks sequential missing values of Discharge = -901 group size (how many -901's in a row)
-df_full['Consec_Length'] = df_full['Discharge'].groupby(df_full['Discharge'].diff().ne(0).cumsum()).transform('size')
-
-# Compute max allowable gap in missing timesteps for interpolation 
-TS_gap = int(MaxGap/Timestep)
-
-# Create flag to identify sections of missing data (-901) less than the max allowable gap 
-df_full['Interp_Flag'] = np.where(((df_full['Discharge'] == -901) & (df_full['Consec_Length'] <= TS_gap)), 1, 0)
-
-# Set Discharge = NaN for rows with Interp_Flag == 1 and Discharge == -901 
-# Need to do this to enable interpolation in these rows (ie. can't interpolate on -901 because its treated as actual data)
-df_full['Discharge'] = np.where(((df_full['Interp_Flag'] == 1) & (df_full['Discharge'] == -901)), np.nan, df_full['Discharge'])
-
-# Interpolate on rows where Interp_Flag = 1 
-print("Interpolating missing data in gaps less than {} timesteps".format(TS_gap))
-df_full['Discharge'] = np.where((df_full['Interp_Flag'] == 1), df_full['Discharge'].interpolate(), df_full['Discharge'])
-print("Filled records: {}".format(len(df_full[df_full['Interp_Flag'] == 1])))
-
-# Quick check plot to verify interpolation looks good
-f, ax = plt.subplots(figsize=(20,12))
-ax.plot(df_full['Discharge'], label='Discharge')
-ax.plot()
-ax.legend()
-#ax.grid()
-ax.set_xlabel('Datetime')
-ax.set_ylabel('Gage Value')
-plt.savefig('gage_data.png', bbox_inches='tight')
-
-# Make an interactive plot from a trimmed df with Pandas-Bokeh, save it out to html 
-#pandas_bokeh.output_file("gage_plot.html")
-#df_trim = df_full.drop(columns=['Consec_Length','Interp_Flag'])
-#df_trim.plot_bokeh()
-
-# Write final, filled data to file
-print("Writing output file")
-ColNames = ['Discharge']
-fout = FileName[:-4]+'_filled.csv'
-df_full.to_csv(fout, columns=ColNames, index_label='Datetime', date_format=DateFormat)
-
-# Extract a new df of the rows where interpolation occurred (0 < Consec_Length < TS_gap)
-df_interp = df_full[df_full['Interp_Flag'] == 1]
-
-# Write summary of missing data & filled data
-fn = FileName[:-4]+'_missing_interp_summary.csv'
-
-# Setup the template for header above dataframe in csv, followed by 3 blank rows and then the dataframe
-template1 = """\
-Timesteps missing data:\n
-{}"""
-
-with open(fn, 'w') as f:
-    f.write(template1.format(df_missing.to_csv(columns=ColNames, index_label='Datetime', date_format=DateFormat)))
-
-template2 = """\
-\nTimesteps interpolated:\n
-{}"""    
-
-with open(fn, 'a') as f:
-    f.write(template2.format(df_interp.to_csv(columns=ColNames, index_label='Datetime', date_format=DateFormat)))
-
-print("Filled gage data file: {}".format(fout))
-print("Summary of missing and filled date/times: {}".format(fn))
-print("Gage data plot: {}".format('gage_data.png'))
\ No newline at end of file
+if Streaming:
+	if FillMethod != 'linear':
+		raise ValueError("Streaming mode only supports the linear fill, set Streaming = False to use {}".format(FillMethod))
+	if Duplicates != 'first':
+		raise ValueError("Streaming mode keeps the first of duplicate readings, set Streaming = False to use {}".format(Duplicates))
+
+	# Fill the record in chunks, gaps spanning two chunks are carried over and still measured against MaxGap
+	print("Streaming input file: {} ({} rows per chunk)".format(FileName, ChunkSize))
+	filler = Gage_Fill_Stream.stream_fill_file(FileName, Agency, Timestep, MaxGap, HeaderLines, ColumnNames, Delimiter,
+		DateFormat=DateFormat, ChunkSize=ChunkSize, TimeZone=TimeZone)
+
+	print("Note that daylight savings timestamps are shifted back to standard time from the input data")
+	print("Timeseries start = {}".format(Gage_Fill_Engine.format_minutes([filler.start_time])[0]))
+	print("Timeseries end = {}".format(Gage_Fill_Engine.format_minutes([filler.end_time])[0]))
+	print("Missing records: {}".format(filler.num_missing))
+	print("Filled records: {}".format(filler.num_filled))
+	print("Duplicate or out of order records dropped: {}".format(filler.dropped))
+	print("Filled gage data file: {}".format(FileName[:-4]+'_filled.csv'))
+	print("Summary of missing and filled date/times: {}".format(FileName[:-4]+'_missing_interp_summary.csv'))
+
+else:
+	# Load the gage data into a Pandas dataframe
+	print("Reading input file: {}".format(FileName))
+	df = pd.read_csv(FileName, delimiter=Delimiter, header=HeaderLines, names=ColumnNames, index_col=False)
+
+	# Manage timestamps
+	if Agency == "KC": # King County
+		# Convert to datetime64 format, rounded to the nearest 15 mins
+		# Timestamps in a known fixed layout are parsed straight to integer minutes (see Gage_Fill_Engine.parse_timestamps)
+		minutes = Gage_Fill_Engine.parse_timestamps(df['Collect Date (UTC)'], round_to=15)
+		df['Collect Date (UTC)'] = pd.to_datetime(minutes, unit='m')
+
+		# Create new Datetime column for analysis equal to UTC shifted to standard time, PST unless TimeZone is set (avoids dealing with daylight savings times)
+		df['Datetime'] = pd.to_datetime(minutes + Gage_Fill_Engine.zone_shift('UTC', TimeZone or 'PST'), unit='m')
+
+	elif Agency == "USGS":
+		# Convert to datetime64 format, rounded to the nearest 15 mins
+		# Timestamps in a known fixed layout are parsed straight to integer minutes (see Gage_Fill_Engine.parse_timestamps)
+		minutes = Gage_Fill_Engine.parse_timestamps(df['Datetime'], round_to=15)
+
+		# Shift every time to standard time in one integer add, the offset of each Timezone code (PDT, MDT, EST, ...)
+		# comes from a small lookup table (Gage_Fill_Engine.TZ_OFFSETS), e.g. PDT times go back 1 hr to PST
+		df['Datetime'] = pd.to_datetime(minutes + Gage_Fill_Engine.standard_time_shift(df['Timezone'], TimeZone), unit='m')
+
+	# Set the Datetime column as the index
+	df.set_index('Datetime', inplace=True)
+
+	# Create complete timeseries at each timestep, get first and last time stamps
+	start_time = df.index[0]
+	end_time = df.index[-1]
+
+	# Print read data for user verification
+	print("Check correct columns were read \nNote that daylight savings timestamps are shifted back to standard time from the input data")
+	print("Timeseries start = {}".format(start_time.strftime('%Y-%m-%d %H:%M')))
+	print("Timeseries end = {}".format(end_time.strftime('%Y-%m-%d %H:%M')))
+	print("Gage value start = {:.1f}".format(df['Discharge'][0]))
+
+	# Create a complete timeseries with 15-min timestep and a new dataframe to store the complete, filled timeseries
+	# tz=None ensures this is timezone-naive
+	delta = timedelta(minutes=Timestep)
+	times = pd.date_range(start=start_time, end=end_time, freq=delta, tz=None)
+
+	# Merge readings that share a timestamp into one value (first, last, mean or max, see Duplicates above)
+	# This occurs when the gage sometimes reads out data like, for example, 06:14 and then 06:15, since we rounded timestamps to the nearest 15 mins above.
+	# Also occurs at the autumn changeover from PDT to PST, where there is a duplicate hour of records back to back.
+	obs_minutes, obs_values, obs_counts = Gage_Fill_Engine.merge_duplicates(Gage_Fill_Engine.to_epoch_minutes(df.index.values),
+		df['Discharge'].values, Duplicates)
+	print("Duplicate readings merged ({}): {} into {} timesteps".format(Duplicates, len(df) - len(obs_minutes), (obs_counts > 1).sum()))
+
+	# Place the merged readings on the complete timeseries in one pass, leaves NaN where timestep is missing in original df
+	placed, hits = Gage_Fill_Engine.place_on_grid(Gage_Fill_Engine.to_epoch_minutes(times.values), obs_minutes, obs_values, np.nan,
+		return_hits=True)
+	df_full = pd.DataFrame({'Discharge': placed}, index=times)
+
+	# Determine number of missing records in the original timeseries
+	Num_missing = len(times) - hits
+	print("Missing records: {}".format(Num_missing))
+
+	# Extract a new df of the original Datetime formatted Discharge rows with missing values
+	df_missing = df_full[df_full['Discharge'].isnull()]
+
+	# Fill missing timesteps (currently saved as NaN) with '-901' 
+	df_full['Discharge'] = df_full['Discharge'].where(df_full['Discharge'].notnull(), -901)
+
+	# Create column which tracks sequential missing values of Discharge = -901 group size (how many -901's in a row)
+	df_full['Consec_Length'] = df_full['Discharge'].groupby(df_full['Discharge'].diff().ne(0).cumsum()).transform('size')
+
+	# Compute max allowable gap in missing timesteps for interpolation 
+	TS_gap = int(MaxGap/Timestep)
+
+	# Create flag to identify sections of missing data (-901) less than the max allowable gap 
+	df_full['Interp_Flag'] = np.where(((df_full['Discharge'] == -901) & (df_full['Consec_Length'] <= TS_gap)), 1, 0)
+
+	# Set Discharge = NaN for rows with Interp_Flag == 1 and Discharge == -901 
+	# Need to do this to enable interpolation in these rows (ie. can't interpolate on -901 because its treated as actual data)
+	df_full['Discharge'] = np.where(((df_full['Interp_Flag'] == 1) & (df_full['Discharge'] == -901)), np.nan, df_full['Discharge'])
+
+	# Interpolate on rows where Interp_Flag = 1, all gaps in one call (-901 rows are not used as interpolation points)
+	print("Interpolating ({}) missing data in gaps less than {} timesteps".format(FillMethod, TS_gap))
+	interp_rows = np.flatnonzero(df_full['Interp_Flag'].values == 1)
+	filled = df_full['Discharge'].values.copy()
+	filled[interp_rows] = Gage_Fill_Engine.interpolate_rows(filled, interp_rows, FillMethod, int(FillPeriod/Timestep))
+	df_full['Discharge'] = filled
+	print("Filled records: {}".format(len(df_full[df_full['Interp_Flag'] == 1])))
+
+	# Quick check plot to verify interpolation looks good
+	if Plot:
+		# Agg draws straight to file, so this also works on machines with no display
+		import matplotlib
+		matplotlib.use('Agg')
+		import matplotlib.pyplot as plt
+		import seaborn as sns
+		# Seaborn settings
+		sns.set(style="darkgrid")
+		#sns.set_palette(sns.set_palette('colorblind'))
+		sns.set_palette(sns.set_palette('pastel'))
+
+		f, ax = plt.subplots(figsize=(20,12))
+		ax.plot(df_full['Discharge'], label='Discharge')
+		ax.plot()
+		ax.legend()
+		#ax.grid()
+		ax.set_xlabel('Datetime')
+		ax.set_ylabel('Gage Value')
+		plt.savefig('gage_data.png', bbox_inches='tight')
+		plt.close(f)
+
+	# Make an interactive plot from a trimmed df with Pandas-Bokeh, save it out to html 
+	if PlotHtml:
+		import pandas_bokeh
+		pandas_bokeh.output_file("gage_plot.html")
+		df_trim = df_full.drop(columns=['Consec_Length','Interp_Flag'])
+		df_trim.plot_bokeh()
+
+	# Write final, filled data to file, timestamps are formatted for the whole grid at once and rows written in large blocks
+	print("Writing output file")
+	grid_minutes = Gage_Fill_Engine.to_epoch_minutes(df_full.index.values)
+	fout = FileName[:-4]+'_filled.csv'
+	with open(fout, 'w') as f:
+		Gage_Fill_Engine.write_csv_rows(f, grid_minutes, df_full['Discharge'].values, DateFormat, header='Datetime,Discharge')
+	if BinaryOutput:
+		Gage_Fill_Engine.save_timeseries(fout[:-4]+'.npz', grid_minutes, df_full['Discharge'].values)
+		print("Filled gage data binary file: {}".format(fout[:-4]+'.npz'))
+
+	# Extract a new df of the rows where interpolation occurred (0 < Consec_Length < TS_gap)
+	df_interp = df_full[df_full['Interp_Flag'] == 1]
+
+	# Write summary of missing data & filled data
+	fn = FileName[:-4]+'_missing_interp_summary.csv'
+	with open(fn, 'w') as f:
+		f.write("Timesteps missing data:\n\n")
+		Gage_Fill_Engine.write_csv_rows(f, Gage_Fill_Engine.to_epoch_minutes(df_missing.index.values),
+			df_missing['Discharge'].values, DateFormat, header='Datetime,Discharge')
+		f.write("\nTimesteps interpolated:\n\n")
+		Gage_Fill_Engine.write_csv_rows(f, Gage_Fill_Engine.to_epoch_minutes(df_interp.index.values),
+			df_interp['Discharge'].values, DateFormat, header='Datetime,Discharge')
+
+	print("Filled gage data file: {}".format(fout))
+	print("Summary of missing and filled date/times: {}".format(fn))
+	if Plot:
+		print("Gage data plot: {}".format('gage_data.png'))
\ No newline at end of file
@@ -0,0 +1,142 @@
+#!/home/cmeder/miniconda3/bin/python
+
+"""
+Fills several gages onto one shared time axis (a panel) for Timeline plots, TOA and calibration.
+
+- Gages are listed in a manifest csv in the same format as Gage_Fill_Batch.py, with an optional
+  Name column (defaults to the file name) used to label each gage
+- Each gage is read, shifted to standard time (or to TimeZone, so gages in different zones line
+  up) and filled (interpolation of gaps up to MaxGap, as in Gage_Fill_NoData.py) within its own
+  period of record
+- All gages are placed on one regular grid of Timestep covering the earliest to the latest reading
+- Returns: a panel folder of .npy arrays that are memory-mapped on load, so taking a time window
+  or a single gage only reads that part of the file:
+  times.npy  - int64 minutes since 1970-01-01 (standard time or TimeZone), one per row
+  gages.npy  - gage names, one per column
+  values.npy - float64 (time x gage), NaN where there is no value, stored column by column
+  flags.npy  - uint8 (time x gage) quality flag for each value (see FLAG_ below)
+- Optionally also writes the panel as one wide csv (Datetime + a column per gage, -901 for no data)
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import Gage_Fill_Engine
+import Gage_Fill_Stream
+import Gage_Fill_Batch
+
+#
+# USER INPUTS
+#
+Manifest = 'gage_panel.csv' # FileName,Agency[,Name,Timestep,MaxGap,Delimiter,HeaderLines,TimeZone], see Gage_Fill_Batch.py
+PanelDir = 'gage_panel' # folder the panel arrays are written to
+PanelCSV = None # e.g. 'gage_panel_wide.csv' to also write the panel as one csv
+Timestep = 15 # in minutes, shared by every gage in the panel
+FillMethod = 'linear' # 'linear', 'pchip' or 'pattern', see Gage_Fill_NoData.py
+FillPeriod = 1440 # cycle length for the 'pattern' fill in minutes
+Duplicates = 'first' # readings that share a timestep: 'first', 'last', 'mean' or 'max', see Gage_Fill_NoData.py
+DateFormat = '%Y-%m-%d %H:%M'
+TimeZone = None # zone every gage is shifted to, e.g. 'MST' for a panel across zones, None for each gage's standard time
+
+#
+# END USER INPUTS
+#
+
+# Quality flag of each panel cell
+FLAG_OBSERVED = 0 # reading from the gage file
+FLAG_INTERPOLATED = 1 # missing reading filled from the values either side
+FLAG_MISSING = 2 # missing reading in a gap longer than MaxGap (value is NaN)
+FLAG_OUTSIDE = 3 # before the first or after the last reading of this gage (value is NaN)
+
+PANEL_ARRAYS = ['times', 'gages', 'values', 'flags']
+
+
+# Read one gage file, returns (int64 epoch minutes in standard time, values with NaN for blanks)
+# The panel TimeZone, where set, is used for every gage before any TimeZone in the manifest
+def read_gage(job, TimeZone=None):
+	df = pd.read_csv(job['FileName'], delimiter=job['Delimiter'], header=job['HeaderLines'],
+		names=job['ColumnNames'], index_col=False)
+	times = Gage_Fill_Stream.chunk_times(df, job['Agency'], TimeZone or job.get('TimeZone'))
+	return times, pd.to_numeric(df['Discharge'], errors='coerce').values
+
+
+# Fill every gage in jobs onto one shared grid, returns a panel dict of times, gages, values and flags
+def build_panel(jobs, Timestep, FillMethod='linear', FillPeriod=1440, TimeZone=None, Duplicates='first'):
+	records = [read_gage(job, TimeZone) for job in jobs]
+	start = min(t.min() for t, v in records)
+	start -= start % Timestep
+	end = max(t.max() for t, v in records)
+	times = np.arange(start, end + 1, Timestep, dtype=np.int64)
+
+	# Column (Fortran) order keeps each gage contiguous on disk
+	values = np.full((len(times), len(jobs)), np.nan, order='F')
+	flags = np.full((len(times), len(jobs)), FLAG_OUTSIDE, dtype=np.uint8, order='F')
+	for col, (job, (t, v)) in enumerate(zip(jobs, records)):
+		# Fill within this gage's own period of record
+		first = (t.min() - start)//Timestep
+		last = (t.max() - start)//Timestep + 1
+		t, v, counts = Gage_Fill_Engine.merge_duplicates(t, v, Duplicates)
+		gage = Gage_Fill_Engine.place_on_grid(times[first:last], t, v, np.nan)
+		missing = np.isnan(gage)
+		gap_starts, gap_lengths = Gage_Fill_Engine.gap_runs(missing)
+		filled = Gage_Fill_Engine.fill_gaps(gage, gap_starts, gap_lengths, int(job['MaxGap']/Timestep), np.nan,
+			method=FillMethod, period=int(FillPeriod/Timestep))
+
+		values[first:last, col] = filled
+		flags[first:last, col] = np.where(~missing, FLAG_OBSERVED,
+			np.where(np.isnan(filled), FLAG_MISSING, FLAG_INTERPOLATED))
+
+	gages = np.array([job.get('Name') or os.path.splitext(os.path.basename(job['FileName']))[0] for job in jobs])
+	return {'times': times, 'gages': gages, 'values': values, 'flags': flags}
+
+
+# Write a panel to a folder of .npy arrays
+def save_panel(PanelDir, panel):
+	if not os.path.isdir(PanelDir):
+		os.makedirs(PanelDir)
+	for name in PANEL_ARRAYS:
+		np.save(os.path.join(PanelDir, name + '.npy'), panel[name])
+
+
+# Open a saved panel, the arrays are memory-mapped so only the rows and gages used are read
+def load_panel(PanelDir):
+	return {name: np.load(os.path.join(PanelDir, name + '.npy'), mmap_mode='r') for name in PANEL_ARRAYS}
+
+
+# Row slice of the panel from start to end (inclusive), given as text ('2019-01-01 00:00') or epoch minutes
+def time_window(panel, start, end):
+	start, end = [Gage_Fill_Engine.parse_timestamps([t])[0] if isinstance(t, str) else t for t in (start, end)]
+	times = panel['times']
+	return slice(np.searchsorted(times, start, side='left'), np.searchsorted(times, end, side='right'))
+
+
+# Column of the panel for a gage name
+def gage_column(panel, name):
+	return int(np.flatnonzero(np.asarray(panel['gages']) == name)[0])
+
+
+# Write the panel as one wide csv, Datetime + a column per gage with -901 for no data
+def write_panel_csv(fout, panel, DateFormat='%Y-%m-%d %H:%M'):
+	values = np.where(np.isnan(panel['values']), Gage_Fill_Engine.NODATA, panel['values'])
+	df = pd.DataFrame(values, index=pd.to_datetime(panel['times'], unit='m'), columns=panel['gages'])
+	df.to_csv(fout, index_label='Datetime', date_format=DateFormat)
+
+
+if __name__ == '__main__':
+	jobs = Gage_Fill_Batch.build_jobs(Manifest, None, None, None, Gage_Fill_Batch.AgencySettings)
+	print("Filling {} gages onto a {} min panel".format(len(jobs), Timestep))
+	panel = build_panel(jobs, Timestep, FillMethod, FillPeriod, TimeZone, Duplicates)
+
+	print("Panel start = {}".format(Gage_Fill_Engine.format_minutes(panel['times'][:1], DateFormat)[0]))
+	print("Panel end = {}".format(Gage_Fill_Engine.format_minutes(panel['times'][-1:], DateFormat)[0]))
+	for col, name in enumerate(panel['gages']):
+		counts = np.bincount(panel['flags'][:, col], minlength=4)
+		print("{}: {} observed, {} interpolated, {} missing".format(name, counts[FLAG_OBSERVED],
+			counts[FLAG_INTERPOLATED], counts[FLAG_MISSING]))
+
+	save_panel(PanelDir, panel)
+	print("Panel arrays: {}".format(PanelDir))
+	if PanelCSV is not None:
+		write_panel_csv(PanelCSV, panel, DateFormat)
+		print("Panel csv: {}".format(PanelCSV))
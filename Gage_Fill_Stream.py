@@ -0,0 +1,85 @@
+#!/home/cmeder/miniconda3/bin/python
+
+"""
+Streaming (chunked) version of the gage fill in Gage_Fill_NoData_python3.py
+
+- Reads the USGS or KC file in blocks of ChunkSize rows with pandas
+- Applies the same timestamp handling per block (round to 15 mins, daylight savings codes such as
+  PDT -> PST, KC UTC -> PST)
+- Fills each block with Gage_Fill_Engine.StreamingGapFiller, which carries an open gap
+  across block boundaries so it is still measured against MaxGap over its full length
+- Writes filled rows (and the missing/interpolated summary) as they are produced, so memory
+  stays flat regardless of record length
+
+Input records must be in time order (as downloaded). Rows that repeat a time already written
+are dropped, as the in-memory script does for duplicate timestamps.
+
+"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import Gage_Fill_Engine
+
+
+# Convert the timestamps of one block of rows to int64 epoch minutes in standard time
+# (or in TimeZone where given, any code in Gage_Fill_Engine.TZ_OFFSETS)
+def chunk_times(chunk, Agency, TimeZone=None):
+	if Agency == "KC":
+		# UTC rounded to the nearest 15 mins, shifted to PST
+		minutes = Gage_Fill_Engine.parse_timestamps(chunk['Collect Date (UTC)'], round_to=15)
+		return minutes + Gage_Fill_Engine.zone_shift('UTC', TimeZone or 'PST')
+	elif Agency == "USGS":
+		# Local time rounded to the nearest 15 mins, each tz_cd (PDT, MDT, ...) shifted back to standard time
+		minutes = Gage_Fill_Engine.parse_timestamps(chunk['Datetime'], round_to=15)
+		return minutes + Gage_Fill_Engine.standard_time_shift(chunk['Timezone'].values, TimeZone)
+	raise ValueError("Unknown agency: {}".format(Agency))
+
+
+# Write one block of filled rows in the same layout as the in-memory script
+def write_rows(f, times, values, header, DateFormat):
+	Gage_Fill_Engine.write_csv_rows(f, times, values, DateFormat, header='Datetime,Discharge' if header else None)
+
+
+# Fill a gage file in chunks, writing <FileName>_filled.csv and <FileName>_missing_interp_summary.csv
+# Returns the StreamingGapFiller so callers can report its counts
+def stream_fill_file(FileName, Agency, Timestep, MaxGap, HeaderLines, ColumnNames, Delimiter,
+		DateFormat='%Y-%m-%d %H:%M', ChunkSize=500000, TimeZone=None):
+
+	filler = Gage_Fill_Engine.StreamingGapFiller(Timestep, int(MaxGap/Timestep))
+
+	fout = FileName[:-4]+'_filled.csv'
+	fn = FileName[:-4]+'_missing_interp_summary.csv'
+	ftmp = fn + '.tmp'
+
+	reader = pd.read_csv(FileName, delimiter=Delimiter, header=HeaderLines, names=ColumnNames,
+		index_col=False, chunksize=ChunkSize)
+
+	# Missing rows go straight into the summary, interpolated rows are collected in a
+	# temporary file and appended as the second section of the summary at the end
+	with open(fout, 'w') as f_fill, open(fn, 'w') as f_miss, \
+			open(ftmp, 'w') as f_interp:
+		f_miss.write("Timesteps missing data:\n\n")
+		first = True
+		blocks = (filler.push(chunk_times(chunk, Agency, TimeZone), pd.to_numeric(chunk['Discharge'], errors='coerce').values)
+			for chunk in reader)
+		for times, values, missing, interp in _with_finish(blocks, filler):
+			write_rows(f_fill, times, values, first, DateFormat)
+			write_rows(f_miss, times[missing], np.full(missing.sum(), np.nan), first, DateFormat)
+			write_rows(f_interp, times[interp], values[interp], first, DateFormat)
+			first = False
+
+	with open(fn, 'a') as f_miss, open(ftmp, 'r') as f_interp:
+		f_miss.write("\nTimesteps interpolated:\n\n")
+		shutil.copyfileobj(f_interp, f_miss)
+	os.remove(ftmp)
+
+	return filler
+
+
+# Yield the filled blocks followed by whatever the filler still holds at the end of the file
+def _with_finish(blocks, filler):
+	for block in blocks:
+		yield block
+	yield filler.finish()
@@ -0,0 +1,139 @@
+#!/home/cmeder/miniconda3/bin/python
+
+"""
+Synthetic gage records for testing and benchmarking the gage fill scripts.
+
+- Writes USGS RDB (tab separated, local time with PST/PDT codes) and King County (csv, UTC
+  with a few minutes of logger jitter) layouts, read with the same settings as real downloads
+- Controls record length, the rate and size distribution of gaps, blank readings, repeated
+  timestamps and whether daylight savings changeovers are included
+- Values are a smooth daily cycle plus storm peaks and noise, so interpolated values can be
+  checked by eye
+- Returns: the generated file, plus the UTC times and values written for checking results
+
+"""
+
+import numpy as np
+import Gage_Fill_Engine
+
+#
+# USER INPUTS (used when run directly)
+#
+FileName = 'synthetic_usgs.txt'
+Agency = "USGS" # USGS or KC layout
+NumRows = 100000 # readings written (before duplicates are added)
+Timestep = 15 # in minutes
+GapRate = 0.01 # chance of a gap after each reading
+GapMean = 6 # mean gap length in timesteps (geometric distribution, so many short gaps and a few long ones)
+BlankFraction = 0.01 # fraction of readings written with no value
+DuplicateFraction = 0.001 # fraction of readings written twice with the same timestamp
+DST = True # USGS layout only, False writes every time as PST
+Seed = 0
+Start = '2018-10-01 00:00' # UTC
+
+#
+# END USER INPUTS
+#
+
+# Header rows of the USGS layout, data starts after 33 lines (HeaderLines = 32 in the fill scripts)
+USGS_HEADER_LINES = 33
+
+
+# UTC times and values of a synthetic record, duplicates of a time follow the first reading
+def synthetic_series(NumRows, Timestep=15, GapRate=0.01, GapMean=6, BlankFraction=0.01,
+		DuplicateFraction=0.001, Seed=0, Start='2018-10-01 00:00'):
+	rng = np.random.default_rng(Seed)
+
+	# Each reading is one timestep after the last, plus a gap of geometric length where one occurs
+	steps = np.ones(NumRows, dtype=np.int64)
+	gaps = rng.random(NumRows) < GapRate
+	steps[gaps] += rng.geometric(1.0/GapMean, gaps.sum())
+	steps[0] = 0
+	times = Gage_Fill_Engine.parse_timestamps([Start])[0] + np.cumsum(steps)*Timestep
+
+	# Daily cycle, a storm peak roughly every 10 days and some noise
+	days = (times - times[0])/1440.0
+	storms = np.zeros(NumRows)
+	for peak in rng.uniform(0, days[-1] + 1, max(1, int(days[-1]/10))):
+		storms += 400*np.exp(-np.abs(days - peak)*3)
+	values = np.round(80 + 15*np.sin(2*np.pi*days) + storms + rng.normal(0, 1, NumRows), 2)
+	values[rng.random(NumRows) < BlankFraction] = np.nan
+
+	# Repeated timestamps, the second reading has a slightly different value
+	dup = np.flatnonzero(rng.random(NumRows) < DuplicateFraction)
+	times = np.insert(times, dup + 1, times[dup])
+	values = np.insert(values, dup + 1, values[dup] + 1)
+	return times, values
+
+
+# Whether each UTC time falls in Pacific daylight savings time (second Sunday in March 2am PST
+# to first Sunday in November 2am PDT)
+def pacific_dst(utc_minutes):
+	years = np.unique(np.asarray(utc_minutes).astype('datetime64[m]').astype('datetime64[Y]').astype(np.int64) + 1970)
+	starts, ends = [], []
+	for year in years:
+		march = np.datetime64('{}-03-01'.format(year), 'D')
+		november = np.datetime64('{}-11-01'.format(year), 'D')
+		# 1970-01-01 was a Thursday, so (3 - day number) % 7 is the days to the next Sunday
+		second_sunday = march + (3 - march.astype(np.int64)) % 7 + 7
+		first_sunday = november + (3 - november.astype(np.int64)) % 7
+		starts.append(second_sunday.astype('datetime64[m]').astype(np.int64) + 10*60)
+		ends.append(first_sunday.astype('datetime64[m]').astype(np.int64) + 9*60)
+	starts, ends = np.array(starts), np.array(ends)
+	i = np.searchsorted(starts, utc_minutes, side='right') - 1
+	return (i >= 0) & (utc_minutes < ends[np.maximum(i, 0)])
+
+
+# Text of each value as the agencies write it, blank for no value
+def value_text(values):
+	text = np.char.mod('%.2f', values).astype(object)
+	text[np.isnan(values)] = ''
+	return text
+
+
+# Write a USGS RDB layout record from UTC times and values
+def write_usgs(FileName, times, values, DST=True, site='12345678'):
+	dst = pacific_dst(times) if DST else np.zeros(len(times), dtype=bool)
+	local = Gage_Fill_Engine.format_minutes(times - 8*60 + 60*dst)
+	tz = np.where(dst, 'PDT', 'PST')
+	codes = np.where(np.isnan(values), 'Eqp', 'A')
+	with open(FileName, 'w') as f:
+		f.write("# Synthetic gage record written by Gage_Fill_Synthetic.py\n")
+		for i in range(USGS_HEADER_LINES - 3):
+			f.write("#\n")
+		f.write("agency_cd\tsite_no\tdatetime\ttz_cd\t00060\t00060_cd\n")
+		f.write("5s\t15s\t20d\t6s\t14n\t10s\n")
+		rows = zip(local.tolist(), tz.tolist(), value_text(values).tolist(), codes.tolist())
+		f.write(''.join("USGS\t{}\t{}\t{}\t{}\t{}\n".format(site, t, z, v, c) for t, z, v, c in rows))
+
+
+# Write a King County layout record from UTC times and values, with +/- Jitter minutes on each time
+def write_kc(FileName, times, values, Jitter=5, Seed=0, site='31g'):
+	rng = np.random.default_rng(Seed)
+	logged = times + rng.integers(-Jitter, Jitter + 1, len(times))
+	utc = Gage_Fill_Engine.format_minutes(logged, '%m/%d/%Y %H:%M:%S')
+	local = Gage_Fill_Engine.format_minutes(logged - 8*60, '%m/%d/%Y %H:%M:%S')
+	stage = value_text(np.round(values/50, 2))
+	with open(FileName, 'w') as f:
+		f.write("Site_Code,Collect Date (UTC),Collect Date (local),Stage,Discharge\n")
+		rows = zip(utc.tolist(), local.tolist(), stage.tolist(), value_text(values).tolist())
+		f.write(''.join("{},{},{},{},{}\n".format(site, u, l, s, v) for u, l, s, v in rows))
+
+
+# Generate and write a synthetic record, returns the UTC times and values written
+def make_record(FileName, Agency="USGS", NumRows=100000, Timestep=15, GapRate=0.01, GapMean=6,
+		BlankFraction=0.01, DuplicateFraction=0.001, DST=True, Seed=0, Start='2018-10-01 00:00'):
+	times, values = synthetic_series(NumRows, Timestep, GapRate, GapMean, BlankFraction, DuplicateFraction, Seed, Start)
+	if Agency == "USGS":
+		write_usgs(FileName, times, values, DST)
+	elif Agency == "KC":
+		write_kc(FileName, times, values, Seed=Seed)
+	else:
+		raise ValueError("Unknown agency: {}".format(Agency))
+	return times, values
+
+
+if __name__ == '__main__':
+	times, values = make_record(FileName, Agency, NumRows, Timestep, GapRate, GapMean, BlankFraction,
+		DuplicateFraction, DST, Seed, Start)
+	print("Wrote {} readings to {}".format(len(times), FileName))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+2D time of arrival (TOA) from RAS plan HDF files of dam breach runs
+
+For each pair of failure and no-failure plans, streams the cell water surface (WSE) time series of both
+plans and finds, for every cell of every 2D flow area:
+- the first output interval where the failure WSE exceeds the no-failure WSE by more than threshold (TOA)
+- the peak difference (failure minus no-failure WSE) and when it occurs
+
+Output intervals are read chunk_steps at a time for a block of cells, so memory stays at the number of
+cells however long the run is. Blocks of cells are worked across processes, so a whole inundation map's
+TOA comes from one pass over each HDF.
+
+Writes TOA2D_<failure plan>_<mesh>.csv of cell center x, y, TOA, hours from the start of the run
+(blank/NaN for cells the breach wave never reaches), peak difference and its time.
+The csv can be read into ArcMap using the Add xy data tool.
+
+Pairs with TOA_fromCSV.py (1D cross sections)
+"""
+import h5py
+import numpy as np
+import pandas as pd
+import os
+from multiprocessing import Pool
+
+#%%
+# Set working directory to project
+os.chdir("C:/Egnyte/Private/marissa/Projects/19-039 Klamath Inundation Mapping Revisions/Modeling")
+
+# Specify model results location and the RAS project name (plan files are <project>.pNN.hdf)
+hdf_path = "C:/Egnyte/Private/marissa/Projects/19-039 Klamath Inundation Mapping Revisions/Modeling/RAS/"
+project = "KlamathRiver"
+
+# Specify output location for csv files
+out_path = "GIS/Data/Model Results/TOA/"
+
+# Pairs of failure and no-failure plan numbers, with 2 DIGITS for all plan numbers
+plan_pairs = [("01", "02")]
+
+# set threshold for WSE difference (ft) to indicate TOA
+threshold = 0.01
+
+chunk_steps = 100 # output intervals read at a time, memory is cells per block x chunk_steps
+cell_block = 100000 # cells worked on by each process at a time
+processes = None # number of worker processes, None uses every core
+
+#%%
+# Size of the HDF5 chunk cache used for each results file, in MB
+chunk_cache_mb = 64
+
+# Path of a 2D flow area time series dataset in the plan results
+def results_path(mesh_name, dataset):
+    return f"Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/2D Flow Areas/{mesh_name}/{dataset}"
+
+# Axis of the output intervals in a results dataset. Results are written as (time x cell), older files may
+# be (cell x time), so the time axis is the one that is not the length of the cell list
+def time_axis(dataset, n_cells):
+    return 1 if dataset.shape[1] != n_cells else 0
+
+# Function to read output intervals and cells of a results dataset (slices) as a (time x cell) array,
+# whichever way round the dataset is stored
+def read_block(dataset, axis, steps, cells):
+    return dataset[steps, cells] if axis == 0 else np.transpose(dataset[cells, steps])
+
+# Function to open a plan HDF file with the chunk cache
+def open_plan(file_path):
+    return h5py.File(file_path, 'r', rdcc_nbytes=int(chunk_cache_mb*1024**2), rdcc_nslots=10007)
+
+# Function to read the output interval times of a plan, as text and as hours from the start of the run
+def output_times(hdf5_file, n_times):
+    series = "Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/"
+    stamps = hdf5_file.get(series + "Time Date Stamp")
+    days = hdf5_file.get(series + "Time")
+    stamps = np.char.strip(stamps[:].astype(str)) if stamps is not None else np.arange(n_times).astype(str)
+    hours = (days[:] - days[0])*24 if days is not None else np.arange(n_times, dtype=float)
+    return stamps, hours
+
+# Function to list the 2D flow areas of a plan with their cell center coordinates
+def flow_areas(hdf5_file):
+    areas = hdf5_file.get("Geometry/2D Flow Areas")
+    if areas is None:
+        return {}
+    return {name: areas[name]["Cells Center Coordinate"][:] for name in areas if isinstance(areas[name], h5py.Group)}
+
+#%%
+# Function to find the TOA and peak difference of one block of cells (cells c0 to c1 of a flow area)
+# Walks the time axis of both plans chunk_steps output intervals at a time, keeping for every cell the first
+# interval where the difference exceeds threshold (-1 until it does) and the running peak difference
+def toa_block(job):
+    c0, c1 = job['cells']
+    arrival = np.full(c1 - c0, -1, dtype=np.int64)
+    peak = np.full(c1 - c0, -np.inf)
+    peak_step = np.full(c1 - c0, -1, dtype=np.int64)
+    cells = np.arange(c1 - c0)
+    with open_plan(job['fail_file']) as fail_hdf, open_plan(job['nofail_file']) as nofail_hdf:
+        fail = fail_hdf[results_path(job['mesh_name'], "Water Surface")]
+        nofail = nofail_hdf[results_path(job['mesh_name'], "Water Surface")]
+        for start in range(0, job['n_times'], chunk_steps):
+            stop = min(start + chunk_steps, job['n_times'])
+            steps = slice(start, stop)
+            difference = (read_block(fail, job['axis'], steps, slice(c0, c1))
+                          - read_block(nofail, job['axis'], steps, slice(c0, c1)))
+            difference[np.isnan(difference)] = -np.inf
+
+            # First crossing in this chunk for the cells the wave has not reached yet
+            crossed = difference > threshold
+            new = (arrival < 0) & crossed.any(axis=0)
+            arrival[new] = start + crossed[:, new].argmax(axis=0)
+
+            # Running peak, strictly greater keeps the first time the peak is reached
+            step = difference.argmax(axis=0)
+            chunk_peak = difference[step, cells]
+            higher = chunk_peak > peak
+            peak[higher] = chunk_peak[higher]
+            peak_step[higher] = start + step[higher]
+
+    peak[np.isinf(peak)] = np.nan
+    return job['key'], c0, arrival, peak, peak_step
+
+# Function to list the TOA jobs, one per block of cells of each flow area of each plan pair
+def find_jobs(plan_pairs):
+    jobs, areas = [], {}
+    for fail_plan, nofail_plan in plan_pairs:
+        fail_file = f"{hdf_path}{project}.p{fail_plan}.hdf"
+        nofail_file = f"{hdf_path}{project}.p{nofail_plan}.hdf"
+        with open_plan(fail_file) as fail_hdf, open_plan(nofail_file) as nofail_hdf:
+            for mesh_name, centers in flow_areas(fail_hdf).items():
+                wse = fail_hdf[results_path(mesh_name, "Water Surface")]
+                if len(centers) not in wse.shape:
+                    raise ValueError(f"Water Surface of plan {fail_plan} does not have one value per cell in {mesh_name}")
+                axis = time_axis(wse, len(centers))
+                n_times = wse.shape[axis]
+                if nofail_hdf[results_path(mesh_name, "Water Surface")].shape != wse.shape:
+                    raise ValueError(f"Plans {fail_plan} and {nofail_plan} have different output intervals or cells in {mesh_name}")
+                key = (fail_plan, mesh_name)
+                areas[key] = {'centers': centers, 'times': output_times(fail_hdf, n_times)}
+                for c0 in range(0, len(centers), cell_block):
+                    jobs.append({'key': key, 'fail_file': fail_file, 'nofail_file': nofail_file, 'mesh_name': mesh_name,
+                                 'n_times': n_times, 'axis': axis, 'cells': (c0, min(c0 + cell_block, len(centers)))})
+    return jobs, areas
+
+#%%
+# Work every block across processes, then write one csv per failure plan and flow area
+if __name__ == '__main__':
+    jobs, areas = find_jobs(plan_pairs)
+    print(f"Finding TOA for {sum(len(a['centers']) for a in areas.values())} cells in {len(jobs)} blocks")
+
+    results = {key: {'arrival': np.full(len(a['centers']), -1, dtype=np.int64), 'peak': np.full(len(a['centers']), np.nan),
+                     'peak_step': np.full(len(a['centers']), -1, dtype=np.int64)} for key, a in areas.items()}
+    with Pool(processes=processes) as pool:
+        for key, c0, arrival, peak, peak_step in pool.imap_unordered(toa_block, jobs):
+            results[key]['arrival'][c0:c0 + len(arrival)] = arrival
+            results[key]['peak'][c0:c0 + len(peak)] = peak
+            results[key]['peak_step'][c0:c0 + len(peak_step)] = peak_step
+
+    for (fail_plan, mesh_name), result in results.items():
+        stamps, hours = areas[(fail_plan, mesh_name)]['times']
+        arrival, peak_step = result['arrival'], result['peak_step']
+        arrived = arrival >= 0
+
+        # Cells the wave never reaches get a blank TOA and NaN hours, not the first output interval
+        TOA_df = pd.DataFrame(areas[(fail_plan, mesh_name)]['centers'], columns=["x", "y"])
+        TOA_df['TOA'] = np.where(arrived, stamps[np.maximum(arrival, 0)], "")
+        TOA_df['TOA_hours'] = np.where(arrived, hours[np.maximum(arrival, 0)], np.nan)
+        TOA_df['PeakDiff'] = result['peak']
+        TOA_df['PeakDiff_time'] = np.where(peak_step >= 0, stamps[np.maximum(peak_step, 0)], "")
+
+        TOA_filename = f"{out_path}TOA2D_{fail_plan}_{mesh_name.replace(' ', '_')}.csv"
+        TOA_df.to_csv(TOA_filename, index=False)
+        print(f"{fail_plan} / {mesh_name}: {arrived.sum()} of {len(arrived)} cells reached, {TOA_filename}")
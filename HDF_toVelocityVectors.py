@@ -7,8 +7,20 @@ Reads Velocity Vectors From a RAS plan HDF file
 Note that before the plan is run, you must set the output options to write velocity vectors
 plan window -> Options -> Output Options… -> HDF5 Write Parameters -> check Write Velocity data
 
-This script reads a spcecified plan's HDF file and writes a csv of the x, y, Vx, and Vy data
-The csv can be read into ArcMap using the Add xy data tool. 
+This script reads every plan HDF file in a project folder (or a list of plan numbers) and writes the x, y,
+Vx, and Vy data (plus speed and direction) for each 2D flow area, named from the plan title in the HDF
+Points are written as a GeoPackage layer in the model projection (read from the HDF) that opens directly in
+ArcGIS/QGIS, or as a csv that can be read into ArcMap using the Add xy data tool
+Only the exported output interval (the last by default) is read from the HDF, not the whole time series
+Plans and flow areas are exported in parallel across processes
+
+Optional extras, each computed while the plan is read:
+- the peak velocity at each point and the peak WSE and depth of each cell (with the time of each peak),
+  found in chunks of output intervals so memory does not grow with run length
+- the bed shear stress and the critical grain size for incipient motion (Shields) at each point, from the
+  velocity, the depth (cell WSE minus bed) and a Manning's n
+- velocity and WSE time series interpolated at probe points or along a profile line, from KD-tree
+  spatial indexes of the face points and cell centers that are cached per geometry
 
 Pairs with Schwinn dt incipient motion script
 
@@ -18,6 +30,14 @@ import h5py
 import numpy as np
 import pandas as pd
 import os
+import re
+import glob
+import pickle
+import hashlib
+import sqlite3
+import datetime
+from multiprocessing import Pool
+from scipy.spatial import cKDTree
 
 #%%
 # Set working directory to project
@@ -29,49 +49,456 @@ hdf_path = "C:/Egnyte/Shared/Projects/22-028 Rutledge_Johnson/Hydraulics/Updated
 # Specify output location for csv files
 out_path = "GIS/Data/Model Results/Existing/Incipient Motion/"
 
-# Create a list of plan numbers and names, with 2 DIGITS for all plan numbers
-plans = 
+# Create a list of plan numbers, with 2 DIGITS for all plan numbers (e.g. ["11", "12"])
+# None exports every plan HDF (*.pNN.hdf) in hdf_path. Plan names are read from the plan title in each HDF
+plans = None
+
+timestep = -1 # single output interval to export (an index, e.g. 0 the first), -1 is the last (steady state)
+envelopes = False # also export the peak velocity at each face point and the peak WSE/depth of each cell, with the time they occur
+chunk_steps = 100 # output intervals read at a time when finding the peaks, memory is (face points or cells) x chunk_steps
+processes = None # number of worker processes, None uses every core
+
+# Incipient motion (Shields) at each face point, from the exported velocity and the depth at the same output interval
+incipient_motion = False # needs the Water Surface and Cells FacePoint Indexes datasets in the plan HDF
+mannings_n = 0.035 # roughness for the bed shear stress, None uses the cell Manning's n in the geometry (Cells Center Manning's n)
+shields = 0.047 # critical Shields parameter
+specific_gravity = 2.65 # of the bed sediment
+units = "US" # model units, "US" (ft, shear stress in lb/ft2) or "SI" (m, shear stress in N/m2), grain size is in mm for both
+
+export_points = True # write VelPoints (and CellMax) files of every face point, False to only probe
+out_format = "gpkg" # "gpkg" writes GeoPackage point layers in the model projection (open directly in ArcGIS/QGIS), "csv" for Add XY data
+
+# Probes: velocity and WSE time series interpolated at points or along a profile line, for every plan
+probe_file = None # csv of Name,x,y probe points, or of x,y vertices of a profile line in order, None for no probes
+probe_spacing = None # distance between points placed along the profile line (model units), None treats probe_file as points
+probe_neighbours = 4 # nearest face points / cells each probe value is interpolated from (inverse distance weighting)
+index_cache = "GIS/Data/Model Results/Existing/Probe Index/" # folder for the cached spatial indexes, None keeps them in memory only
 
 #%%
-# Function to read face points and x and y velocity components from hdf5 file
-def read_hdf5_datasets(file_path, mesh_name):
-    with h5py.File(file_path, 'r') as hdf5_file:
+# Size of the HDF5 chunk cache used for each results file, in MB. Velocity datasets are stored in chunks
+# that span several nodes and output intervals, so the cache should hold at least one row of chunks
+chunk_cache_mb = 64
+
+# Path of a 2D flow area time series dataset in the plan results
+def results_path(mesh_name, dataset):
+    return f"Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/2D Flow Areas/{mesh_name}/{dataset}"
+
+# Axis of the output intervals in a results dataset. Results are written as (time x node), older files may
+# be (node x time), so the time axis is the one that is not the length of the node list
+def time_axis(dataset, n_nodes):
+    return 1 if dataset.shape[1] != n_nodes else 0
+
+# Function to read only the requested output interval(s) of a time series dataset, as an HDF hyperslab
+# timestep is a single index into the output intervals (-1 is the last) or a slice of them, returns the
+# values at each node (one column per output interval for a slice)
+def read_timesteps(dataset, n_nodes, timestep):
+    axis = time_axis(dataset, n_nodes)
+    n_times = dataset.shape[axis]
+    if isinstance(timestep, slice):
+        index = timestep
+    elif np.ndim(timestep) == 0:
+        index = int(timestep) % n_times
+    else:
+        raise ValueError(f"timestep must be a single output interval, not {timestep}")
+    data = dataset[:, index] if axis == 1 else dataset[index, :]
+    return data if axis == 1 else np.transpose(data)
+
+# Function to read every output interval at a few nodes (sorted node indices), returns one row per node
+def read_nodes(dataset, n_nodes, nodes):
+    nodes = list(nodes)
+    return np.transpose(dataset[:, nodes]) if time_axis(dataset, n_nodes) == 0 else dataset[nodes, :]
+
+# Function to read a geometry coordinate dataset as one (x, y) row per node
+def read_coordinates(dataset):
+    coordinates = dataset[:]
+    return coordinates if coordinates.shape[1] == 2 else np.transpose(coordinates)
+
+# Function to average cell values onto the face points around each cell, as listed in Cells FacePoint Indexes
+# (one row per cell, padded with -1). Cells with NaN are left out, face points with no cell value get NaN
+def cells_to_facepoints(cell_values, cell_facepoints, n_points):
+    n_cells = min(len(cell_values), len(cell_facepoints))
+    cells = np.repeat(np.arange(n_cells), cell_facepoints.shape[1])
+    points = cell_facepoints[:n_cells].ravel()
+    keep = (points >= 0) & ~np.isnan(cell_values[cells])
+    total = np.bincount(points[keep], weights=cell_values[cells][keep], minlength=n_points)
+    count = np.bincount(points[keep], minlength=n_points)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+# Function to read face points and x and y velocity components at the requested timestep from hdf5 file
+# Only the needed slice of each velocity dataset is read, so memory scales with the mesh size, not mesh x time
+# With incipient=True the depth (cell WSE minus cell minimum elevation, wet cells averaged onto the face points)
+# and Manning's n at each face point are read in the same pass
+def read_hdf5_datasets(file_path, mesh_name, timestep=-1, cache_mb=chunk_cache_mb, incipient=False, mannings_n=None):
+    with h5py.File(file_path, 'r', rdcc_nbytes=int(cache_mb*1024**2), rdcc_nslots=10007) as hdf5_file:
         # Construct the paths for the datasets
-        dataset_path_x_velocity = f"Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/2D Flow Areas/{mesh_name}/Node Velocity - Velocity X"
-        dataset_path_y_velocity = f"Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/2D Flow Areas/{mesh_name}/Node Velocity - Velocity Y"
+        dataset_path_x_velocity = results_path(mesh_name, "Node Velocity - Velocity X")
+        dataset_path_y_velocity = results_path(mesh_name, "Node Velocity - Velocity Y")
         dataset_path_geometry = f"Geometry/2D Flow Areas/{mesh_name}/FacePoints Coordinate"
-        
-        # Read the datasets
-        data_x_velocity = hdf5_file[dataset_path_x_velocity][:]
-        data_y_velocity = hdf5_file[dataset_path_y_velocity][:]
-        data_geometry = hdf5_file[dataset_path_geometry][:]
+
+        # Read the datasets, face point coordinates as one (x, y) row per node
+        data_geometry = read_coordinates(hdf5_file[dataset_path_geometry])
+        n_nodes = len(data_geometry)
+        data_x_velocity = read_timesteps(hdf5_file[dataset_path_x_velocity], n_nodes, timestep)
+        data_y_velocity = read_timesteps(hdf5_file[dataset_path_y_velocity], n_nodes, timestep)
+
+        data = {
+            'cells_center_coordinate': data_geometry, 
+            'x_velocity': data_x_velocity, 
+            'y_velocity': data_y_velocity
+        }
+
+        if incipient:
+            geometry = f"Geometry/2D Flow Areas/{mesh_name}/"
+            cell_facepoints = hdf5_file[geometry + "Cells FacePoint Indexes"][:]
+            bed = hdf5_file[geometry + "Cells Minimum Elevation"][:]
+            wse = hdf5_file[results_path(mesh_name, "Water Surface")]
+            cell_depth = read_timesteps(wse, len(bed), timestep) - bed
+            cell_depth[~(cell_depth > 0)] = np.nan # dry cells
+            data['depth'] = cells_to_facepoints(cell_depth, cell_facepoints, n_nodes)
+            if mannings_n is None:
+                data['mannings_n'] = cells_to_facepoints(hdf5_file[geometry + "Cells Center Manning's n"][:],
+                                                         cell_facepoints, n_nodes)
+            else:
+                data['mannings_n'] = np.full(n_nodes, mannings_n)
+
+    return data
+
+# Specific weight of water, Manning's equation constant and the length unit in mm, for each unit system
+UNIT_CONSTANTS = {"US": (62.4, 1.486, 304.8), "SI": (9810.0, 1.0, 1000.0)}
+
+# Function to compute the bed shear stress (Manning's equation with the hydraulic radius taken as the depth,
+# tau = gamma n^2 V^2 / (k^2 h^(1/3))) and the critical grain size for incipient motion from the Shields
+# parameter (D = tau / (shields (Ss - 1) gamma), in mm), vectorized over every node. Dry nodes get NaN
+def incipient_grain_size(velocity, depth, n, shields=shields, specific_gravity=specific_gravity, units=units):
+    gamma, k, mm = UNIT_CONSTANTS[units]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shear = np.where(depth > 0, gamma * (n * velocity / k)**2 / np.cbrt(depth), np.nan)
+    grain_size = shear / (shields * (specific_gravity - 1) * gamma) * mm
+    return shear, grain_size
+
+# Function to walk the time axis of (time x node) results datasets chunk_steps output intervals at a time,
+# keeping the running maximum of value(*chunks) at each node and the output interval it occurs in, so memory
+# stays at nodes x chunk_steps however long the run is. Nodes where value is NaN throughout get NaN and -1
+def max_over_time(datasets, n_nodes, value, chunk_steps=chunk_steps):
+    n_times = datasets[0].shape[time_axis(datasets[0], n_nodes)]
+    peak = np.full(n_nodes, -np.inf)
+    when = np.full(n_nodes, -1, dtype=np.int64)
+    nodes = np.arange(n_nodes)
+    for start in range(0, n_times, chunk_steps):
+        chunk = value(*[read_timesteps(d, n_nodes, slice(start, start + chunk_steps)) for d in datasets])
+        chunk = np.where(np.isnan(chunk), -np.inf, chunk)
+        step = chunk.argmax(axis=1)
+        chunk_peak = chunk[nodes, step]
+        # Strictly greater keeps the first time the peak is reached
+        higher = chunk_peak > peak
+        peak[higher] = chunk_peak[higher]
+        when[higher] = start + step[higher]
+    peak[np.isinf(peak)] = np.nan
+    return peak, when
+
+# Function to read the output interval time stamps of a plan, as text (index numbers if the plan has none)
+def output_times(hdf5_file, n_times):
+    stamps = hdf5_file.get("Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/Time Date Stamp")
+    if stamps is None:
+        return np.arange(n_times).astype(str)
+    return np.char.strip(stamps[:].astype(str))
+
+# Function to find the peak velocity magnitude at each face point and the peak WSE and depth of each cell
+# (depth is WSE minus the cell minimum elevation), with the time each occurs, in one chunked pass over each dataset
+# RAS writes the WSE of a dry cell as its minimum elevation, so only WSE above the bed counts as wet: cells that are
+# never wet get blank WSEmax, Depthmax and time. Face points that never flow have a velocity of 0 throughout
+def read_envelopes(file_path, mesh_name, cache_mb=chunk_cache_mb):
+    with h5py.File(file_path, 'r', rdcc_nbytes=int(cache_mb*1024**2), rdcc_nslots=10007) as hdf5_file:
+        geometry = f"Geometry/2D Flow Areas/{mesh_name}/"
+        n_points = len(read_coordinates(hdf5_file[geometry + "FacePoints Coordinate"]))
+        velocity = [hdf5_file[results_path(mesh_name, "Node Velocity - Velocity X")],
+                    hdf5_file[results_path(mesh_name, "Node Velocity - Velocity Y")]]
+        v_max, v_when = max_over_time(velocity, n_points, np.hypot)
+
+        cells = read_coordinates(hdf5_file[geometry + "Cells Center Coordinate"])
+        bed = hdf5_file[geometry + "Cells Minimum Elevation"][:]
+        wse = hdf5_file[results_path(mesh_name, "Water Surface")]
+        wse_max, wse_when = max_over_time([wse], len(cells), lambda w: np.where(w > bed[:, None], w, np.nan))
+
+        times = output_times(hdf5_file, wse.shape[time_axis(wse, len(cells))])
+
+    # Time of each peak as text, blank where a cell is never wet
+    def time_text(when):
+        return np.where(when >= 0, times[np.maximum(when, 0)], "")
 
     return {
-        'cells_center_coordinate': data_geometry, 
-        'x_velocity': data_x_velocity, 
-        'y_velocity': data_y_velocity
+        'velocity_max': v_max,
+        'velocity_max_time': time_text(v_when),
+        'cells_center_coordinate': cells,
+        'wse_max': wse_max,
+        'wse_max_time': time_text(wse_when),
+        'depth_max': wse_max - bed
     }
 
 #%%
-# Read points for given plan, change path to plan files
-plan_num = "11"
-plan_name = "20yr"
+# Spatial indexes (KD-trees) already built in this process, keyed by a hash of the coordinates
+spatial_indexes = {}
+
+# Function to get the KD-tree of a set of face point or cell center coordinates, built once per geometry
+# Plans that share a geometry have the same coordinates, so the tree is found again in memory or in cache_dir
+def spatial_index(coordinates, cache_dir=index_cache):
+    key = hashlib.sha1(np.ascontiguousarray(coordinates).tobytes()).hexdigest()[:16]
+    if key in spatial_indexes:
+        return spatial_indexes[key]
+    cache_file = os.path.join(cache_dir, f"tree_{key}.pkl") if cache_dir is not None else None
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            tree = pickle.load(f)
+    else:
+        tree = cKDTree(coordinates)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Written to a temporary file first so another process never reads a partial index
+            with open(cache_file + f".{os.getpid()}", 'wb') as f:
+                pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_file + f".{os.getpid()}", cache_file)
+    spatial_indexes[key] = tree
+    return tree
+
+# Function to read the probe file: Name,x,y points, or the x,y vertices of a profile line with points placed
+# every spacing along it (named by station, the distance along the line from its first vertex)
+def read_probes(probe_file, spacing=None):
+    probes = pd.read_csv(probe_file)
+    if spacing is None:
+        if 'Name' not in probes:
+            probes['Name'] = [str(i) for i in range(len(probes))]
+        return probes[['Name', 'x', 'y']]
+    vertices = probes[['x', 'y']].values
+    vertex_station = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(vertices, axis=0).T))))
+    station = np.arange(0, vertex_station[-1] + spacing/2, spacing)
+    station[-1] = min(station[-1], vertex_station[-1])
+    return pd.DataFrame({'Name': np.round(station, 2).astype(str), 'Station': station,
+                         'x': np.interp(station, vertex_station, vertices[:, 0]),
+                         'y': np.interp(station, vertex_station, vertices[:, 1])})
+
+# Function to read the time series of a results dataset at the k nearest nodes of each probe and interpolate them by
+# inverse distance weighting (nodes with NaN are left out, and with bed given, cells with WSE at or below the bed,
+# which is how RAS writes a dry cell). Only the columns of the nodes used are read from the HDF. Returns (time x probe) values
+def probe_series(dataset, n_nodes, nodes, weights, bed=None):
+    columns, inverse = np.unique(nodes, return_inverse=True)
+    series = read_nodes(dataset, n_nodes, columns)[inverse.reshape(nodes.shape)]
+    wet = ~np.isnan(series)
+    if bed is not None:
+        wet &= series > bed[nodes][:, :, None]
+    weights = np.where(wet, weights[:, :, None], 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.transpose((np.where(wet, series, 0)*weights).sum(axis=1) / weights.sum(axis=1))
+
+# Function to find the k nearest nodes of each probe and their inverse distance weights, and the distance to the nearest
+def probe_weights(tree, probes, k=probe_neighbours):
+    distance, nodes = tree.query(probes[['x', 'y']].values, k=k)
+    distance, nodes = distance.reshape(len(probes), -1), nodes.reshape(len(probes), -1)
+    # A probe on a node takes its value
+    weights = 1/np.maximum(distance, 1e-9)**2
+    return nodes, weights/weights.sum(axis=1, keepdims=True), distance[:, 0]
+
+# Function to interpolate velocity (from the face points) and WSE (from the cell centers) time series at every probe,
+# returns one row per probe and output interval
+def probe_plan(file_path, mesh_name, probes, cache_mb=chunk_cache_mb):
+    with h5py.File(file_path, 'r', rdcc_nbytes=int(cache_mb*1024**2), rdcc_nslots=10007) as hdf5_file:
+        geometry = f"Geometry/2D Flow Areas/{mesh_name}/"
+        facepoints = read_coordinates(hdf5_file[geometry + "FacePoints Coordinate"])
+        cells = read_coordinates(hdf5_file[geometry + "Cells Center Coordinate"])
+        bed = hdf5_file[geometry + "Cells Minimum Elevation"][:]
+
+        nodes, weights, point_distance = probe_weights(spatial_index(facepoints), probes)
+        vx = probe_series(hdf5_file[results_path(mesh_name, "Node Velocity - Velocity X")], len(facepoints), nodes, weights)
+        vy = probe_series(hdf5_file[results_path(mesh_name, "Node Velocity - Velocity Y")], len(facepoints), nodes, weights)
+        nodes, weights, cell_distance = probe_weights(spatial_index(cells), probes)
+        wse = probe_series(hdf5_file[results_path(mesh_name, "Water Surface")], len(cells), nodes, weights, bed)
+        times = output_times(hdf5_file, len(wse))
+
+    n_times = len(times)
+    Probe_df = pd.DataFrame({'Time': np.tile(times, len(probes))})
+    for column in probes.columns:
+        Probe_df[column] = np.repeat(probes[column].values, n_times)
+    # Distance from each probe to the nearest face point, large where a probe is outside this flow area
+    Probe_df['Distance'] = np.repeat(point_distance, n_times)
+    Probe_df['Vx'] = np.transpose(vx).ravel()
+    Probe_df['Vy'] = np.transpose(vy).ravel()
+    Probe_df['Velocity'] = np.hypot(Probe_df['Vx'], Probe_df['Vy'])
+    Probe_df['WSE'] = np.transpose(wse).ravel()
+    return Probe_df
+
+#%%
+# GeoPackage spatial reference id used for the model projection (ids from 100000 up are left for user definitions)
+GPKG_SRS_ID = 100000
+
+# Function to read the model projection (WKT) stored in the plan HDF attributes, None if the model has none
+def read_projection(hdf5_file):
+    projection = hdf5_file.attrs.get("Projection")
+    if projection is None:
+        return None
+    projection = projection.decode() if isinstance(projection, bytes) else str(projection)
+    return projection.strip() or None
+
+# Function to encode points as GeoPackage geometry blobs (GP header with no envelope + little endian WKB point),
+# built for every point at once as one packed numpy record array
+def gpkg_points(x, y, srs_id):
+    blob = np.zeros(len(x), dtype=[('magic', 'S2'), ('version', 'u1'), ('flags', 'u1'), ('srs_id', '<i4'),
+                                   ('byte_order', 'u1'), ('wkb_type', '<u4'), ('x', '<f8'), ('y', '<f8')])
+    blob['magic'] = b'GP'
+    blob['flags'] = 1 # little endian, no envelope
+    blob['srs_id'] = srs_id
+    blob['byte_order'] = 1
+    blob['wkb_type'] = 1 # point
+    blob['x'] = x
+    blob['y'] = y
+    data = memoryview(blob.tobytes())
+    size = blob.dtype.itemsize
+    return [data[i:i + size] for i in range(0, len(data), size)]
 
-#Update
-filepath = f"{hdf_path}JanRoad.p{plan_num}.hdf"
-mesh_name = "FlowArea"
+# Function to write a DataFrame with x and y columns as a GeoPackage point layer in one bulk insert, with the model
+# projection (WKT) as its coordinate system. The file is replaced if it exists. Written with sqlite3, no GIS packages
+def write_geopackage(filename, layer, df, projection=None):
+    if os.path.exists(filename):
+        os.remove(filename)
+    srs_id = GPKG_SRS_ID if projection is not None else -1
+    sql_types = {'f': 'DOUBLE', 'i': 'INTEGER', 'u': 'INTEGER', 'b': 'BOOLEAN'}
+    columns = [c for c in df.columns if c not in ('x', 'y')]
+    column_defs = ''.join(f', "{c}" {sql_types.get(df[c].dtype.kind, "TEXT")}' for c in columns)
+    extent = (df['x'].min(), df['y'].min(), df['x'].max(), df['y'].max())
 
-hdf_data = read_hdf5_datasets(filepath, mesh_name)
+    with sqlite3.connect(filename) as db:
+        db.execute("PRAGMA application_id = 1196444487") # 'GPKG'
+        db.execute("PRAGMA user_version = 10200")
+        db.execute("CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, "
+                   "organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, "
+                   "description TEXT)")
+        db.executemany("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", [
+            ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+            ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+            ("WGS 84 geodetic", 4326, "EPSG", 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,'
+             '298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]', None)])
+        if projection is not None:
+            db.execute("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+                       ("RAS model projection", srs_id, "NONE", srs_id, projection, "From the plan HDF"))
+        db.execute("CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, "
+                   "identifier TEXT UNIQUE, description TEXT DEFAULT '', last_change DATETIME NOT NULL, "
+                   "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER)")
+        db.execute("INSERT INTO gpkg_contents VALUES (?, 'features', ?, '', ?, ?, ?, ?, ?, ?)",
+                   (layer, layer, datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'), *extent, srs_id))
+        db.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, "
+                   "geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, "
+                   "PRIMARY KEY (table_name, column_name))")
+        db.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'POINT', ?, 0, 0)", (layer, srs_id))
 
-# Get last time step of velocity (for steady state) for x and y and add to cell coordinates
-x_vel = hdf_data['x_velocity'][:, -1]
-y_vel = hdf_data['y_velocity'][:, -1]
+        # Feature table, all rows in one executemany (NaN values are stored as NULL)
+        db.execute(f'CREATE TABLE "{layer}" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom POINT{column_defs})')
+        placeholders = ', '.join(['?']*(len(columns) + 1))
+        names = ', '.join(['geom'] + [f'"{c}"' for c in columns])
+        values = [df[c].tolist() for c in columns]
+        db.executemany(f'INSERT INTO "{layer}" ({names}) VALUES ({placeholders})',
+                       zip(gpkg_points(df['x'].values, df['y'].values, srs_id), *values))
+    return filename
+
+# Function to write a table of points as a GeoPackage layer or a csv (out_format), returns the file written
+def write_points(df, name, projection=None):
+    if out_format == "gpkg":
+        return write_geopackage(f"{out_path}{name}.gpkg", name, df, projection)
+    df.to_csv(f"{out_path}{name}.csv", index=False)
+    return f"{out_path}{name}.csv"
+
+#%%
+# Function to read the plan title (the short ID if there is no title) from the plan HDF attributes
+def plan_title(hdf5_file, file_path):
+    info = hdf5_file.get("Plan Data/Plan Information")
+    for key in ("Plan Title", "Plan ShortID"):
+        if info is not None and key in info.attrs:
+            title = info.attrs[key]
+            return (title.decode() if isinstance(title, bytes) else str(title)).strip()
+    return os.path.basename(file_path)
 
-points = np.transpose(hdf_data['cells_center_coordinate'])
+# Function to make a plan or mesh name safe to use in a file name
+def safe_name(name):
+    return re.sub(r'[^\w\-]+', '_', name).strip('_')
 
-Vel_points = np.column_stack((points, x_vel, y_vel))
-Vel_points_df = pd.DataFrame(Vel_points, columns=["x", "y", "Vx", "Vy"])
+# Function to list every plan HDF file and 2D flow area to export, one job per plan and flow area
+def find_jobs(hdf_path, plans=None):
+    files = sorted(glob.glob(os.path.join(hdf_path, "*.p[0-9][0-9].hdf")))
+    if plans is not None:
+        files = [f for f in files if f[-6:-4] in plans]
+
+    jobs = []
+    for file_path in files:
+        with h5py.File(file_path, 'r') as hdf5_file:
+            plan_name = plan_title(hdf5_file, file_path)
+            projection = read_projection(hdf5_file)
+            areas = hdf5_file.get("Geometry/2D Flow Areas")
+            # Each flow area is a group, the other members hold attributes of all areas
+            meshes = [name for name in areas if isinstance(areas[name], h5py.Group)] if areas is not None else []
+        for mesh_name in meshes:
+            # The mesh name is only added to the output file name where a plan has more than one flow area
+            out_name = safe_name(plan_name) if len(meshes) == 1 else f"{safe_name(plan_name)}_{safe_name(mesh_name)}"
+            jobs.append({'file_path': file_path, 'plan_name': plan_name, 'mesh_name': mesh_name, 'out_name': out_name,
+                         'projection': projection})
+    return jobs
+
+# Function to export the velocity points of one plan and flow area, never raises so one bad plan does not stop the batch
+def export_mesh(job):
+    try:
+        outputs = []
+        if export_points:
+            hdf_data = read_hdf5_datasets(job['file_path'], job['mesh_name'], timestep, incipient=incipient_motion,
+                                          mannings_n=mannings_n)
+
+            # Velocity for x and y at the requested time step (only that slice is read), added to cell coordinates
+            x_vel = hdf_data['x_velocity']
+            y_vel = hdf_data['y_velocity']
+
+            points = hdf_data['cells_center_coordinate']
+
+            Vel_points = np.column_stack((points, x_vel, y_vel))
+            Vel_points_df = pd.DataFrame(Vel_points, columns=["x", "y", "Vx", "Vy"])
+
+            # Speed and direction (degrees clockwise from north, the geographic rotation used to symbolise arrows)
+            Vel_points_df['Speed'] = np.hypot(x_vel, y_vel)
+            Vel_points_df['Direction'] = np.degrees(np.arctan2(x_vel, y_vel)) % 360
+
+            # Shear stress and the critical grain size for incipient motion at each point, from the same read
+            if incipient_motion:
+                shear, grain_size = incipient_grain_size(Vel_points_df['Speed'].values, hdf_data['depth'], hdf_data['mannings_n'])
+                Vel_points_df['Depth'] = hdf_data['depth']
+                Vel_points_df['Shear'] = shear
+                Vel_points_df['Dcrit_mm'] = grain_size
+
+            # Peak velocity at each face point over the whole run, and the peak WSE and depth of each cell
+            if envelopes:
+                env = read_envelopes(job['file_path'], job['mesh_name'])
+                Vel_points_df['Vmax'] = env['velocity_max']
+                Vel_points_df['Vmax_time'] = env['velocity_max_time']
+                Cell_max_df = pd.DataFrame(env['cells_center_coordinate'], columns=["x", "y"])
+                Cell_max_df['WSEmax'] = env['wse_max']
+                Cell_max_df['WSEmax_time'] = env['wse_max_time']
+                Cell_max_df['Depthmax'] = env['depth_max']
+                outputs.append(write_points(Cell_max_df, f"CellMax_{job['out_name']}", job['projection']))
+
+            # Write to GeoPackage or CSV
+            outputs.append(write_points(Vel_points_df, f"VelPoints_{job['out_name']}", job['projection']))
+
+        # Velocity and WSE time series at the probe points
+        if probe_file is not None:
+            Probe_df = probe_plan(job['file_path'], job['mesh_name'], read_probes(probe_file, probe_spacing))
+            output_filename = f"{out_path}Probes_{job['out_name']}.csv"
+            Probe_df.to_csv(output_filename, index=False)
+            outputs.append(output_filename)
+        return f"OK      {job['plan_name']} / {job['mesh_name']}: {', '.join(outputs)}"
+    except Exception as e:
+        return f"FAILED  {job['plan_name']} / {job['mesh_name']} ({job['file_path']}): {type(e).__name__}: {e}"
+
+#%%
+# Export every plan and flow area, each worker opens its own plan file
+if __name__ == '__main__':
+    jobs = find_jobs(hdf_path, plans)
+    print(f"Exporting velocity points for {len(jobs)} plan flow areas")
 
-# Write to CSV
-output_filename = f"{out_path}VelPoints_{plan_name}.csv"
-Vel_points_df.to_csv(output_filename, index=False)
\ No newline at end of file
+    with Pool(processes=processes) as pool:
+        # imap_unordered reports each plan as soon as it finishes
+        for result in pool.imap_unordered(export_mesh, jobs):
+            print(result)
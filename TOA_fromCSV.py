@@ -6,19 +6,42 @@ Created on Wed Feb 19 10:19:44 2020
 """
 
 import os
+import numpy as np
 import pandas as pd
 
 # set directory for inputs and outputs (adjust as needed)
 path = "C:/Egnyte/Private/marissa/Projects/19-039 Klamath Inundation Mapping Revisions/Modeling/Excel/Modeling and Mapping Revisions/DSS_Export"
 os.chdir(path)
 
-# Make Vector of required XS values    
-Keno_XS = [234.844,233.474,231.474,229.974,229.45,228.974,227.974,226.974,226.430,226.179,224.474,223.216,
-           221.695,220.974,219.140,217.268,216.249,214.974,214.474,212.245,210.474,209.242,208.690,208.474,207.505,
-           206.452,205.674,204.174,202.186,201.156,200.102,199.891,199.57,197.446,193.581,191.864,191.64,
-           191.151,186.033,180.675,178.563,178.188,176.339,166.757,161.242,157.424,150.377,142.116,133.682,
-           129.586,123.987,108.381,107.368,106.302,99.1,94.632,89.126,83.835,78.716,71.033,65.826,59.799,
-           58.812,49.185,43.137,39.64,35.373,25.418,23.48,16.047,10.822,6.618,3.614,0.661]
+# read stage series straight from DSS ('DSS') or from HEC-DSSVue exported tables ('TXT', e.g. PMF_KENO_F.txt)
+source = 'DSS'
+
+# DSS file for each flow and DSS pathname parts (same scheme as GroupsForDSS.py), part B is the XS and
+# part F is '<flow> <dam> F XS' or '<flow> <dam> NF XS'. part D is the time window read from each record
+dss_files = {'PMF': "C:/Egnyte/Private/marissa/Projects/19-039 Klamath Inundation Mapping Revisions/Modeling/Final/Final/KlamathRiver.dss",
+             'FW': "C:/Egnyte/Private/marissa/Projects/19-039 Klamath Inundation Mapping Revisions/Modeling/Final/Final/KlamathRiver.dss"}
+partA = 'KLAMATH RIVER MAIN'
+partC = 'STAGE'
+partD = {'PMF': "22DEC3100 - 03JAN3101",
+         'FW': "24DEC3100 - 09JAN3101"}
+partE = '3MIN'
+
+if source == 'DSS':
+    from pydsstools.heclib.dss import HecDss
+
+# Make Vector of required XS values, as written in the DSS part B
+Keno_XS = ['234.844','233.474','231.474','229.974','229.45','228.974',
+           '227.974','226.974','226.430','226.179','224.474','223.216',
+           '221.695','220.974','219.140','217.268','216.249','214.974',
+           '214.474','212.245','210.474','209.242','208.690','208.474',
+           '207.505','206.452','205.674','204.174','202.186','201.156',
+           '200.102','199.891','199.57','197.446','193.581','191.864',
+           '191.64','191.151','186.033','180.675','178.563','178.188',
+           '176.339','166.757','161.242','157.424','150.377','142.116',
+           '133.682','129.586','123.987','108.381','107.368','106.302',
+           '99.1','94.632','89.126','83.835','78.716','71.033','65.826',
+           '59.799','58.812','49.185','43.137','39.64','35.373','25.418',
+           '23.48','16.047','10.822','6.618','3.614','0.661']
 JCB_XS = Keno_XS[9:]
 Copco_XS = JCB_XS[22:]
 IG_XS = Copco_XS[5:]
@@ -35,119 +58,135 @@ TOA_dict = {}
 # set threshold for stage difference (ft) to indicate TOA
 threshold = 0.01
 
-# define first greater function
-def first_greater(df, n):
-    m = df.ge(n)
-    return m.any() and m.idxmax()
+# minutes between rows of the stage series (3MIN DSS records)
+timestep = 3
+
+# flood stage (ft) at each XS by river mile, e.g. {10.822: 2051.5}, XS not listed get no time to flood stage
+flood_stage = {}
+
+# index of the first time step at or above the threshold for every cross section (column) at once,
+# cross sections that never reach it get NEVER_ARRIVES rather than the first time step
+NEVER_ARRIVES = -1
+
+def first_greater(values, n):
+    m = values >= n
+    return np.where(m.any(axis=0), m.argmax(axis=0), NEVER_ARRIVES)
+
+# time (hours) each column first rises to level, linearly interpolated between the time steps either
+# side of the crossing; NaN where it never does. level is one value or one per column
+def crossing_hours(values, level, hours):
+    idx = first_greater(values, level)
+    step = np.clip(idx, 1, len(hours) - 1)
+    cols = np.arange(values.shape[1])
+    before, after = values[step - 1, cols], values[step, cols]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.clip((level - before)/(after - before), 0, 1)
+    crossing = hours[step - 1] + fraction*(hours[step] - hours[step - 1])
+    crossing = np.where(idx == 0, hours[0], np.where(np.isnan(crossing), hours[step], crossing))
+    return idx, np.where(idx == NEVER_ARRIVES, np.nan, crossing)
+
+# all TOA metrics for every cross section from the failure stage and stage difference arrays (time x XS):
+# first time step over threshold, interpolated crossing time, peak stage and its time, time to
+# flood stage and wave celerity (mph) from the next XS upstream (river miles decrease downstream)
+def toa_metrics(fail_values, difference, XS_list, time_comb):
+    hours = np.arange(len(fail_values))*timestep/60.0
+    times = time_comb.to_numpy()
+    idx, toa_hours = crossing_hours(difference, threshold, hours)
+    peak = np.where(np.isnan(fail_values), -np.inf, fail_values).argmax(axis=0)
+    stages = np.array([flood_stage.get(xs, np.nan) for xs in XS_list])
+    flood_hours = crossing_hours(fail_values, stages, hours)[1]
+    
+    travel = np.diff(toa_hours)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        celerity = np.where(travel > 0, -np.diff(XS_list)/travel, np.nan)
+    
+    return {'TOA': np.where(idx == NEVER_ARRIVES, None, times[np.maximum(idx, 0)]),
+            'TOA_hours': toa_hours,
+            'PeakStage': fail_values[peak, np.arange(len(peak))],
+            'PeakTime': times[peak],
+            'PeakTime_hours': hours[peak],
+            'FloodStage_hours': flood_hours,
+            'Celerity_mph': np.concatenate([[np.nan], celerity])}
  
+# DSS files opened once and reused for every dam and flow
+dss_handles = {}
+
+# Function to read the failure and no failure stage series of every XS for a dam and flow from DSS,
+# one column per XS, trimmed to the times either run has a stage
+def read_dss_stages(flow, dam, XS_names):
+    dss_file = dss_files[flow]
+    if dss_file not in dss_handles:
+        dss_handles[dss_file] = HecDss.Open(dss_file)
+    start, end = partD[flow].split(' - ')
+    window = (start + ' 00:00:00', end + ' 24:00:00')
+    
+    runs = []
+    for run in ['F', 'NF']:
+        stages = []
+        for XS in XS_names:
+            pathname = "/{}/{}/{}//{}/{} {} {} XS/".format(partA, XS, partC, partE, flow, dam, run)
+            ts = dss_handles[dss_file].read_ts(pathname, window = window, trim_missing = False)
+            values = np.array(ts.values, dtype = float)
+            values[np.asarray(ts.nodata, dtype = bool)] = np.nan
+            stages.append(values)
+        runs.append(np.column_stack(stages))
+        times = np.array(ts.pytimes)
+    
+    fail_values, nofail_values = runs
+    rows = np.flatnonzero(~np.isnan(fail_values).all(axis = 1) | ~np.isnan(nofail_values).all(axis = 1))
+    rows = slice(rows[0], rows[-1] + 1) if len(rows) else slice(0, 0)
+    time_comb = pd.Series([t.strftime('%d%b%Y %H:%M') for t in times[rows]])
+    return pd.DataFrame(fail_values[rows]), pd.DataFrame(nofail_values[rows]), time_comb
+
 
 # Loop over PMF and Fair Weather runs
 for dam in dam_list:
     
     # loop over dams
+    metrics = {'XS': [float(XS) for XS in XS_dict[dam]]}
      
     for flow in flow_list:
         
         #chose appropriate XS list for dam
-        XS_list = XS_dict[dam]
-        
-        # create file name for dam and flow
-        f_file = '{}_{}_F.txt'.format(flow, dam)
-        nf_file = '{}_{}_NF.txt'.format(flow, dam)
-        
-        # read files into dataframe
-        fail  = pd.read_csv(f_file, sep = ",", header = 1)
-        no_fail = pd.read_csv(nf_file, sep = ",", header = 1)
-        
-        # get only XS data (no date/time)
-        fail_data = fail.iloc[:, 2:]
-        nofail_data = no_fail.iloc[:, 2:]
-        
-        # difference the failure and no fail stage data
-        difference = fail_data.subtract(nofail_data, fill_value = 0)
-        
-        # combine date and time into single list
-        time_comb = fail['Type'] + fail[' ']
+        XS_list = metrics['XS']
         
-        # loop over columns (cross sections)
-        i = 0
-        time_df = list()
+        if source == 'DSS':
+            # read failure and no fail stages for all XS straight from DSS
+            fail_data, nofail_data, time_comb = read_dss_stages(flow, dam, XS_dict[dam])
         
-        
-        while i < len(difference.columns):
-            
-            # select column of a single cross section
-            idx_df = difference[difference.columns[i]]
+        else:
+            # create file name for dam and flow
+            f_file = '{}_{}_F.txt'.format(flow, dam)
+            nf_file = '{}_{}_NF.txt'.format(flow, dam)
             
-            # find index of first time difference is above threshold
-            idx = first_greater(idx_df, threshold)
+            # read files into dataframe
+            fail  = pd.read_csv(f_file, sep = ",", header = 1)
+            no_fail = pd.read_csv(nf_file, sep = ",", header = 1)
             
-            # find time of the first difference
-            time_df.append(time_comb[idx])
+            # get only XS data (no date/time)
+            fail_data = fail.iloc[:, 2:]
+            nofail_data = no_fail.iloc[:, 2:]
             
-            i+=1
+            # combine date and time into single list
+            time_comb = fail['Type'] + fail[' ']
         
-        # get times for PMF and FW runs
-        if flow == 'PMF':
-            time_pmf = time_df
-        else: 
-            time_fw = time_df
+        # difference the failure and no fail stage data
+        difference = fail_data.subtract(nofail_data, fill_value = 0)
+        
+        # find every metric for all cross sections in one pass, columns named by metric and flow
+        for name, values in toa_metrics(fail_data.to_numpy(dtype=float), difference.to_numpy(), XS_list, time_comb).items():
+            metrics['{}_{}'.format(name, flow)] = values
     
     # Combine data into single dataframe      
-    df = pd.DataFrame(
-            {'XS': XS_list,
-             'TOA_PMF': time_pmf,
-             'TOA_FW': time_fw})
+    df = pd.DataFrame(metrics)
     
     # write to text file
     TOA_filename = "{}/{}_{}_TOA.csv".format(path,flow,dam)        
     df.to_csv(TOA_filename)
 
 # save all data to one dictionary    
-    TOA_dict[dam]  = df      
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
\ No newline at end of file
+    TOA_dict[dam]  = df
+
+# close DSS files
+for dss_handle in dss_handles.values():
+    dss_handle.close()
@@ -18,8 +18,7 @@ rows of headers followed by the data. The first column of the data should be
 """
 
 import os
-from datetime import datetime, timedelta
-import numpy as np
+import Gage_Fill_Engine
 
 # provide file information
 os.chdir(r'C:\working')
@@ -28,96 +27,58 @@ Qcol=3
 TScol=2
 timestep=15 # in minutes
 MaxGap=180 # in minutes
+FillMethod='linear' # 'linear', 'pchip' (monotone cubic) or 'pattern' (mean cycle plus linear trend)
+FillPeriod=1440 # cycle length for the 'pattern' fill in minutes, e.g. 1440 daily, 525600 seasonal
+TimeZone=None # None shifts to the gage's standard time (PST for PST/PDT), or a tz code e.g. 'MST', 'UTC'
 
 # create variables
 date_str=[];
 discharge=[];
-dobj=[];
+tz=[];
 
 # Read in data
 f=open(filename,'r')
 a=f.readlines()
 f.close()
 for line in a:
-    if line[0]=='U':  
+    if line[0]=='U':
+        fields=line.split('\t')
         try:
-            discharge.append(float(line.split('\t')[Qcol-1]))
+            discharge.append(float(fields[Qcol-1]))
         except ValueError:
             discharge.append(-901)
-        if line.split('\t')[TScol]=='PDT': #account for PDT/PST
-            date_object=datetime.strptime(line.split('\t')[TScol-1],'%Y-%m-%d %H:%M')-timedelta(hours=1)
-        else:
-            date_object=datetime.strptime(line.split('\t')[TScol-1],'%Y-%m-%d %H:%M')            
-        dobj.append(date_object)   
-print "Finished reading data"        
+        date_str.append(fields[TScol-1])
+        tz.append(fields[TScol]) #tz_cd column follows the date, e.g. PST/PDT
+print "Finished reading data"
+
+# convert all timestamps to minutes in one go, shifting each tz code (PDT, MDT, ...)
+# to standard time with one add from a small table of offsets
+tmin=Gage_Fill_Engine.parse_timestamps(date_str, '%Y-%m-%d %H:%M')+Gage_Fill_Engine.standard_time_shift(tz, TimeZone)
 
 # print data for check
-st_time=dobj[0]   #datetime.strptime(date_str[0],'%Y-%m-%d %H:%M')
-end_time=dobj[-1] #datetime.strptime(date_str[-1],'%Y-%m-%d %H:%M')
-delta=timedelta(minutes=timestep)
 print "Check correct columns were read..."
-print "Timeseries start = %s" %(st_time)
+print "Timeseries start = %s" %(Gage_Fill_Engine.format_minutes(tmin[:1])[0])
 print "Discharge start = %.1f" %(discharge[0])
 
-# create complete time series of 15 min (above) with no gaps
-times = []    
-tobj=[]
-while st_time < end_time:
-    times.append(st_time.strftime('%Y-%m-%d %H:%M'))
-    tobj.append(st_time)
-    st_time += delta
-          
-# fill gaps - this looks for all time slots with no data and inserts -901
-print "Start filling all gaps in timeseries (this takes a while)"  
-n=0;
-Q=[];      
-for i in range(len(times)):
-    if dobj[n]==tobj[i]:
-        Q.append(discharge[n])
-        n=n+1;
-    else:
-        try:
-            j=dobj.index(tobj[i])
-        except ValueError:
-             j=[]
-        if j:
-            Q.append(discharge[j])
-            n=j+1
-        else:
-            Q.append(-901)
-    if 1*i/float(int(len(times)/10)) % 1 == 0:
-        print "%i percent complete..." %(10*i/float(int(len(times)/10)))
-print "Finished filling gaps"     
-
-#Interpolation routine- this looks for runs of 3hrs of -901
+# create complete time series of 15 min (above) with no gaps and place each
+# observation in its time slot - time slots with no data are filled with -901
+print "Start filling all gaps in timeseries"
+tgrid, Q = Gage_Fill_Engine.fill_regular_grid(tmin, discharge, timestep)
+print "Finished filling gaps"
+
+#Interpolation routine- fills every run of -901 of up to MaxGap in one call
 print "Start interpolating gaps in timeseries"
-Qni=list(Q);
-Qi=list(Q)
-j=1
 TS_gap=int(MaxGap/timestep)
-
-while j:
-    try:
-        k=Q[j+1:].index(-901)
-        j=j+k+1 # replace j 
-        i=1
-        while Q[j+i]==-901:
-            i=i+1
-        if i<=TS_gap: #if the gap in timeseries is less than or equal to max gap
-                #interp lines
-                Q[j:j+i]=np.interp(range(1,i+3),[1,i+2],[Q[j-1],Q[j+i]])[1:-1]
-                j=j+i
-        else:
-                j=j+i
-    except ValueError:
-        j=[]
-        break  
-print "Finished interpolation"      
+gap_starts, gap_lengths = Gage_Fill_Engine.gap_runs(Q == -901)
+# gaps at the start or end of the record have no value on one side and stay -901
+fill = (gap_lengths <= TS_gap) & (gap_starts > 0) & (gap_starts + gap_lengths < len(Q))
+rows = Gage_Fill_Engine.run_positions(gap_starts[fill], gap_lengths[fill])
+Q[rows] = Gage_Fill_Engine.interpolate_rows(Q, rows, FillMethod, int(FillPeriod/timestep))
+print "Finished interpolation"
     
-# Write File
+# Write File - all rows formatted in large blocks, no data written as '-901'
 f = open(filename[:-4]+'_filled.csv', 'wb')
-for i in xrange(len(times)):
-    f.write("{},{}\n".format(times[i], Q[i]))
+Gage_Fill_Engine.write_csv_rows(f, tgrid, Q, nodata_rep='-901')
 f.close()
 print "File write complete ('%s_filled.csv')" %filename[:-4]   
 
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for Gage_Fill_Engine.py, run with pytest from the repository folder
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import Gage_Fill_Engine
+
+
+# PDT rows move back an hour to PST, PST rows are unchanged
+def test_standard_time_shift_pdt_to_pst():
+    shift = Gage_Fill_Engine.standard_time_shift(['PST', 'PDT', 'PDT', 'PST'])
+    assert shift.tolist() == [0, -60, -60, 0]
+
+
+# A blank tz_cd row (empty text or NaN from read_csv) is taken as the gage's standard
+# time instead of stopping the fill, and the gage zone comes from the first non-blank code
+def test_standard_time_shift_blank_code():
+    codes = pd.Series(['', np.nan, 'PDT', ' ', 'PST']).values
+    assert Gage_Fill_Engine.standard_time_shift(codes).tolist() == [0, 0, -60, 0, 0]
+    assert Gage_Fill_Engine.standard_time_shift(codes, 'UTC').tolist() == [480, 480, 420, 480, 480]
+
+
+# A record with no tz codes at all is left as it is
+def test_standard_time_shift_all_blank():
+    assert Gage_Fill_Engine.standard_time_shift(['', '']).tolist() == [0, 0]
+
+
+# Codes that are not blank and not in TZ_OFFSETS still raise
+def test_standard_time_shift_unknown_code():
+    with pytest.raises(ValueError):
+        Gage_Fill_Engine.standard_time_shift(['PST', 'XYZ'])